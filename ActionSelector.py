@@ -0,0 +1,78 @@
+import numpy as np
+import NetworkMdp
+
+# Number of random numbers drawn at a time
+BLOCK_SIZE = 4096
+
+
+class ActionSelector:
+    # Epsilon-greedy action selection shared by the learners. Random numbers come from blocks drawn ahead of time from a
+    # seedable generator, so picking an action doesn't call into the random number generator on every hop and runs with
+    # the same seed make the same choices
+    def __init__(self, seed=None, block_size=BLOCK_SIZE):
+        self.rng = np.random.default_rng(seed)
+        self.block_size = block_size
+        self.block = []
+        self.position = 0
+
+    # Next uniform random number in [0, 1)
+    def uniform(self):
+        if self.position == len(self.block):
+            self.block = self.rng.random(self.block_size).tolist()
+            self.position = 0
+
+        u = self.block[self.position]
+        self.position = self.position + 1
+        return u
+
+    # Array of count uniform random numbers in [0, 1), taken from the same stream as uniform
+    def uniforms(self, count):
+        taken = self.block[self.position:self.position + count]
+        self.position = self.position + len(taken)
+        if len(taken) == count:
+            return np.array(taken)
+        return np.concatenate([taken, self.rng.random(count - len(taken))])
+
+    # With probability epsilon a random action out of the first degree actions, otherwise the given action
+    def epsilon_action(self, action, epsilon, degree):
+        if self.uniform() <= epsilon:
+            return int(self.uniform() * degree)
+        return action
+
+    # Epsilon-greedy action for a row of action values: with probability epsilon a random action, otherwise the action
+    # with the largest value (or smallest, if minimize is set), randomly picking between actions with the same value
+    def select(self, values, epsilon, minimize=False):
+        degree = len(values)
+        if self.uniform() <= epsilon:
+            # Randomly return an action
+            return int(self.uniform() * degree)
+
+        # A plain Python scan is faster than array operations on a row this short
+        values = values.tolist()
+        best = min(values) if minimize else max(values)
+        if best != best:
+            # No actions found that maximize the values (they're NaN), randomly pick one
+            return int(self.uniform() * degree)
+
+        count = values.count(best)
+        if count == 1:
+            return values.index(best)
+
+        # Randomly pick an action from the best actions
+        pick = int(self.uniform() * count)
+        for action, value in enumerate(values):
+            if value == best:
+                if pick == 0:
+                    return action
+                pick = pick - 1
+
+    # Vectorized select for rows of action values laid end to end, with the number of actions in every row
+    def select_batch(self, values, degrees, epsilon, minimize=False):
+        best = np.repeat(NetworkMdp.segment_best(values, degrees, minimize), degrees)
+        ties = np.where(values == best, self.uniforms(values.size), -1.0)
+        actions = NetworkMdp.segment_argbest(ties, degrees)
+
+        # Randomly pick any action instead with probability epsilon
+        explore = self.uniforms(len(actions)) <= epsilon
+        actions[explore] = (self.uniforms(np.count_nonzero(explore)) * degrees[explore]).astype(np.int64)
+        return actions
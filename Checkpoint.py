@@ -0,0 +1,83 @@
+import NetworkMdp
+import json
+import os
+import numpy as np
+
+# Tables saved from the solver itself and from its network (when the solver has them)
+SOLVER_TABLES = ["q", "c"]
+NETWORK_TABLES = ["values", "policies"]
+
+PRECISION_NAMES = {NetworkMdp.FULL: "FULL", NetworkMdp.COMPACT: "COMPACT"}
+
+
+class Checkpoint:
+    def __init__(self, directory):
+        # Every table is stored as its own .npy file in the directory so it can be memory mapped, along with
+        # checkpoint.json describing the run
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def exists(self):
+        return os.path.exists(self.path("checkpoint.json"))
+
+    # Save the solver's tables and node map, along with the number of packets it has been trained on so far
+    def save(self, solver, packets=0):
+        os.makedirs(self.directory, exist_ok=True)
+
+        tables = {name: getattr(solver, name) for name in SOLVER_TABLES if getattr(solver, name, None) is not None}
+        tables.update({name: getattr(solver.network, name) for name in NETWORK_TABLES})
+        tables["nodes"] = solver.network.nodes
+
+        # Write every file under a temporary name first, so processes that have the old checkpoint mapped (or a crash
+        # part way through) never see a half written table
+        for name, table in tables.items():
+            with open(self.path(name + ".npy.tmp"), "wb") as file:
+                np.save(file, table)
+            os.replace(self.path(name + ".npy.tmp"), self.path(name + ".npy"))
+
+        metadata = {
+            "solver": type(solver).__name__,
+            "packets": packets,
+            "mapfile": solver.network.mapfile if isinstance(solver.network.mapfile, str) else None,
+            "topology": solver.network.topology,
+            "precision": solver.network.precision,
+            "tables": sorted(tables.keys())
+        }
+        with open(self.path("checkpoint.json.tmp"), "w") as file:
+            json.dump(metadata, file)
+        os.replace(self.path("checkpoint.json.tmp"), self.path("checkpoint.json"))
+
+    # Restore the solver's tables and node map from the checkpoint, returns the number of packets it had been trained
+    # on. Tables are memory mapped rather than read: with mmap_mode "c" (copy on write) the solver can keep training
+    # without changing the files, with "r" they are read only and the pages are shared between every process that
+    # loads the same checkpoint. mmap_mode None reads them into memory
+    def load(self, solver, mmap_mode="c"):
+        with open(self.path("checkpoint.json")) as file:
+            metadata = json.load(file)
+
+        if metadata["solver"] != type(solver).__name__:
+            raise ValueError(f"Checkpoint is for {metadata['solver']}, not {type(solver).__name__}")
+        if metadata["precision"] != solver.network.precision:
+            raise ValueError(f"Checkpoint was saved with {PRECISION_NAMES[metadata['precision']]} precision, not "
+                             f"{PRECISION_NAMES[solver.network.precision]}")
+
+        # The node map is small and the transition table is rebuilt from it, so it's always read into memory
+        nodes = np.load(self.path("nodes.npy"))
+        if nodes.shape != solver.network.nodes.shape:
+            raise ValueError(f"Checkpoint is for a {nodes.shape} network, not {solver.network.nodes.shape}")
+        solver.network.nodes = nodes.astype(solver.network.nodes.dtype)
+        solver.network.build_transitions()
+
+        for name in metadata["tables"]:
+            if name in SOLVER_TABLES:
+                owner = solver
+            elif name in NETWORK_TABLES:
+                owner = solver.network
+            else:
+                continue
+
+            setattr(owner, name, np.load(self.path(name + ".npy"), mmap_mode=mmap_mode))
+
+        return metadata["packets"]
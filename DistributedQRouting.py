@@ -0,0 +1,496 @@
+import NetworkMdp
+import ActionSelector
+import TrafficGenerator
+import asyncio
+import bisect
+import multiprocessing
+import os
+import queue
+import traceback
+import numpy as np
+from collections import deque
+
+# How the routers run: each partition in its own worker process, or as asyncio tasks in one event loop
+PROCESSES = 0
+TASKS = 1
+
+# Messages between routers, sent in batches
+PACKET = 0      # (PACKET, packet, node, previous node, action, hops): packet arriving at a node, from the previous node
+                # (-1 for a new packet) by taking the action
+ESTIMATE = 1    # (ESTIMATE, node, action, estimate): estimated hops to the destination from the node the action leads to
+
+# Messages between the coordinator and the routers
+BATCH = 2       # (BATCH, messages) from another partition
+INJECT = 3      # (INJECT, messages) of new packets from the coordinator
+DONE = 4        # (DONE, [(packet, hops), ...]) of packets delivered or dropped
+STOP = 5        # (STOP,) once every packet is done, answered with SENT
+SENT = 6        # (SENT, partition, batches sent to every partition)
+FINISH = 7      # (FINISH, batches) the partition still has to receive before it's done, answered with TABLE
+TABLE = 8       # (TABLE, partition, Q rows, message counts)
+UPDATE = 9      # (UPDATE, max_hops, nodes, transitions, Q rows) before a round, None for what hasn't changed, answered
+                # with READY
+READY = 10      # (READY, partition)
+ERROR = 11      # (ERROR, partition, traceback) from a router that raised, which stops running
+CLOSE = 12      # (CLOSE,) to a router that isn't needed anymore
+
+COORDINATOR = -1
+
+# Seconds to wait for a message from the routers before checking they're all still running
+LIVENESS_INTERVAL = 1.0
+
+
+# Start of every partition when splitting the network into bands of rows, as flat node indices, followed by the number
+# of nodes
+def partition_bounds(shape, partitions):
+    rows = np.linspace(0, shape[0], partitions + 1).round().astype(np.int64)
+    return (np.unique(rows) * shape[1]).tolist()
+
+
+class RouterActor:
+    # The routers of the nodes bounds[index] to bounds[index + 1] - 1. The actor only keeps the Q rows of its own nodes,
+    # and only learns about other nodes through the estimates they send back when a packet is forwarded to them. The
+    # rows of the partition's nodes are contiguous in the tables, see NetworkMdp.link_starts
+    def __init__(self, index, bounds, network, q, epsilon, alpha, max_hops, seed=None):
+        self.index = index
+        self.bounds = bounds
+        self.first = bounds[index]
+        last = bounds[index + 1]
+
+        self.nodes = network.nodes.ravel()[self.first:last].copy()
+        links = np.s_[network.link_starts[self.first]:network.link_starts[last]]
+        self.link_starts = network.link_starts[self.first:last + 1] - network.link_starts[self.first]
+        self.transitions = network.transitions.reshape(-1)[links].copy()
+        self.q = q.reshape(-1)[links].copy()
+
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.max_hops = max_hops
+        self.selector = ActionSelector.ActionSelector(seed)
+
+        self.start_round()
+
+    # Batches sent to every partition and received from them, for the coordinator to tell when none are in flight,
+    # and the packet hops and estimates sent within the partition and to other partitions, all counted per round
+    def start_round(self):
+        self.sent = [0] * (len(self.bounds) - 1)
+        self.received = 0
+        self.expected = None
+        self.counts = dict.fromkeys(["packets", "remote_packets", "estimates", "remote_estimates"], 0)
+
+    def owner(self, node):
+        return bisect.bisect_right(self.bounds, node) - 1
+
+    # Handle a message, returning the messages to send as (partition or COORDINATOR, message) pairs
+    def handle(self, message):
+        kind = message[0]
+        if kind == UPDATE:
+            _, max_hops, nodes, transitions, q = message
+            if max_hops is not None:
+                self.max_hops = max_hops
+            if nodes is not None:
+                self.nodes = nodes
+                self.transitions = transitions
+            if q is not None:
+                self.q = q
+            return [(COORDINATOR, (READY, self.index))]
+        if kind == STOP:
+            return [(COORDINATOR, (SENT, self.index, self.sent))]
+        if kind == FINISH:
+            self.expected = message[1]
+            return self.finish()
+        if kind == BATCH:
+            self.received = self.received + 1
+
+        outboxes = {}
+        done = []
+        work = deque(message[1])
+        while work:
+            message = work.popleft()
+            if message[0] == ESTIMATE:
+                _, node, action, estimate = message
+                link = self.link_starts[node - self.first] + action
+                self.q[link] = self.q[link] + self.alpha * (1 + estimate - self.q[link])
+                continue
+
+            _, packet, node, previous, action, hops = message
+            local = node - self.first
+            row = self.q[self.link_starts[local]:self.link_starts[local + 1]]
+            delivered = self.nodes[local] == NetworkMdp.DESTINATION
+
+            if previous >= 0:
+                # Tell the previous node how far the destination is from here
+                self.send((ESTIMATE, previous, action, 0.0 if delivered else float(np.min(row))), "estimates", work,
+                          outboxes)
+
+            if delivered or hops > self.max_hops:
+                done.append((packet, hops))
+                continue
+
+            next_action = self.selector.select(row, self.epsilon, minimize=True)
+            next_node = int(self.transitions[self.link_starts[local] + next_action])
+            self.send((PACKET, packet, next_node, node, next_action, hops + 1), "packets", work, outboxes)
+
+        replies = []
+        for partition, batch in outboxes.items():
+            self.sent[partition] = self.sent[partition] + 1
+            replies.append((partition, (BATCH, batch)))
+        if done:
+            replies.append((COORDINATOR, (DONE, done)))
+        return replies + self.finish()
+
+    # Queue a message to the router of the node it's for, in this partition or another one
+    def send(self, message, count, work, outboxes):
+        partition = self.owner(message[2] if message[0] == PACKET else message[1])
+        if partition == self.index:
+            self.counts[count] = self.counts[count] + 1
+            work.append(message)
+        else:
+            self.counts["remote_" + count] = self.counts["remote_" + count] + 1
+            outboxes.setdefault(partition, []).append(message)
+
+    # Once every batch sent to the partition has arrived, hand the Q rows back to the coordinator and get ready for the
+    # next round
+    def finish(self):
+        if self.expected is None or self.received < self.expected:
+            return []
+        reply = (COORDINATOR, (TABLE, self.index, self.q.copy(), self.counts))
+        self.start_round()
+        return [reply]
+
+
+class Coordinator:
+    # One round of routing: sends the routers the updates they need first (a list of UPDATE messages, one per
+    # partition, or None), then feeds the packets from the origins (flat nodes) to the routers, keeping up to window of
+    # them in flight, and records their hops. Once they're all done it stops the routers and collects their Q rows
+    def __init__(self, bounds, origins, window, updates=None):
+        self.bounds = bounds
+        self.partitions = len(bounds) - 1
+        self.origins = origins
+        self.window = window
+        self.updates = updates
+        self.hops = np.zeros(len(origins), np.int64)
+
+        self.ready = 0
+        self.next_packet = 0
+        self.in_flight = 0
+        self.done = 0
+        self.sent = [None] * self.partitions
+        self.tables = [None] * self.partitions
+        self.finished = False
+
+    def start(self):
+        if self.updates is not None:
+            # Every router has to have its update before any packet can reach it
+            return list(enumerate(self.updates))
+        return self.inject() if len(self.origins) > 0 else self.stop()
+
+    def inject(self):
+        count = min(self.window - self.in_flight, len(self.origins) - self.next_packet)
+        packets = np.arange(self.next_packet, self.next_packet + count)
+        owners = np.searchsorted(self.bounds, self.origins[packets], side="right") - 1
+        self.next_packet = self.next_packet + count
+        self.in_flight = self.in_flight + count
+
+        messages = []
+        for partition in np.unique(owners).tolist():
+            packets_here = packets[owners == partition].tolist()
+            messages.append((partition, (INJECT, [(PACKET, packet, int(self.origins[packet]), -1, -1, 0)
+                                                  for packet in packets_here])))
+        return messages
+
+    def stop(self):
+        return [(partition, (STOP,)) for partition in range(self.partitions)]
+
+    def receive(self, message):
+        kind = message[0]
+        if kind == ERROR:
+            raise RuntimeError(f"Router for partition {message[1]} failed:\n{message[2]}")
+
+        if kind == READY:
+            self.ready = self.ready + 1
+            if self.ready < self.partitions:
+                return []
+            return self.inject() if len(self.origins) > 0 else self.stop()
+
+        if kind == DONE:
+            for packet, hops in message[1]:
+                self.hops[packet] = hops
+            self.in_flight = self.in_flight - len(message[1])
+            self.done = self.done + len(message[1])
+            if self.done == len(self.origins):
+                return self.stop()
+            return self.inject()
+
+        if kind == SENT:
+            self.sent[message[1]] = message[2]
+            if all(sent is not None for sent in self.sent):
+                expected = np.sum(self.sent, axis=0).tolist()
+                return [(partition, (FINISH, expected[partition])) for partition in range(self.partitions)]
+            return []
+
+        if kind == TABLE:
+            self.tables[message[1]] = (message[2], message[3])
+            self.finished = all(table is not None for table in self.tables)
+        return []
+
+
+# Worker process: handle the actor's messages until it's closed. If the actor raises, the coordinator is told instead of
+# being left waiting for it
+def run_process(actor, inboxes, results):
+    try:
+        while True:
+            message = inboxes[actor.index].get()
+            if message[0] == CLOSE:
+                break
+            for destination, reply in actor.handle(message):
+                (results if destination == COORDINATOR else inboxes[destination]).put(reply)
+    except BaseException:
+        results.put((ERROR, actor.index, traceback.format_exc()))
+        raise
+
+
+async def run_task(actor, inboxes, results):
+    try:
+        while True:
+            message = await inboxes[actor.index].get()
+            if message[0] == CLOSE:
+                break
+            for destination, reply in actor.handle(message):
+                (results if destination == COORDINATOR else inboxes[destination]).put_nowait(reply)
+    except Exception:
+        results.put_nowait((ERROR, actor.index, traceback.format_exc()))
+
+
+class ProcessRouters:
+    # Actors running in their own worker process each, which stay up between rounds until closed. Waiting for a message
+    # gives up with an error when a process has died, or after timeout seconds (never by default)
+    def __init__(self, actors, timeout=None):
+        self.timeout = timeout
+        self.inboxes = [multiprocessing.Queue() for actor in actors]
+        self.results = multiprocessing.Queue()
+        self.processes = [multiprocessing.Process(target=run_process, args=(actor, self.inboxes, self.results),
+                                                  daemon=True)
+                          for actor in actors]
+        for process in self.processes:
+            process.start()
+
+    def put(self, partition, message):
+        self.inboxes[partition].put(message)
+
+    def get(self):
+        waited = 0.0
+        while True:
+            try:
+                return self.results.get(timeout=LIVENESS_INTERVAL)
+            except queue.Empty:
+                pass
+
+            # A router that raised sends an ERROR before exiting, which is passed on if it's still on its way
+            dead = [index for index, process in enumerate(self.processes) if process.exitcode is not None]
+            if dead:
+                try:
+                    return self.results.get(timeout=LIVENESS_INTERVAL)
+                except queue.Empty:
+                    pass
+                raise RuntimeError(f"Router process for partition {dead[0]} exited with code "
+                                   f"{self.processes[dead[0]].exitcode}")
+            waited = waited + LIVENESS_INTERVAL
+            if self.timeout is not None and waited >= self.timeout:
+                raise TimeoutError(f"No message from the routers for {self.timeout} seconds")
+
+    def close(self):
+        for process, inbox in zip(self.processes, self.inboxes):
+            if process.is_alive():
+                inbox.put((CLOSE,))
+        for process in self.processes:
+            process.join(LIVENESS_INTERVAL)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for inbox in self.inboxes + [self.results]:
+            inbox.close()
+
+
+class TaskRouters:
+    # Actors running as asyncio tasks in an event loop of their own, which stay up between rounds until closed. The
+    # loop only runs while waiting for a message, and gives up with an error when a task has ended, or after timeout
+    # seconds (never by default)
+    def __init__(self, actors, timeout=None):
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.inboxes = [asyncio.Queue() for actor in actors]
+        self.results = asyncio.Queue()
+        self.tasks = [self.loop.create_task(run_task(actor, self.inboxes, self.results)) for actor in actors]
+
+    def put(self, partition, message):
+        self.inboxes[partition].put_nowait(message)
+
+    def get(self):
+        return self.loop.run_until_complete(self.next_result())
+
+    async def next_result(self):
+        waited = 0.0
+        while True:
+            try:
+                return await asyncio.wait_for(self.results.get(), LIVENESS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+            # A router that raised has sent an ERROR before ending, so only one that ended without it is left here
+            ended = [index for index, task in enumerate(self.tasks) if task.done()]
+            if ended:
+                raise RuntimeError(f"Router task for partition {ended[0]} ended")
+            waited = waited + LIVENESS_INTERVAL
+            if self.timeout is not None and waited >= self.timeout:
+                raise TimeoutError(f"No message from the routers for {self.timeout} seconds")
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*self.tasks, return_exceptions=True))
+        self.loop.close()
+
+
+class DistributedQRouting:
+    # Q-routing where the network is split into bands of rows, each routed by its own actor (a worker process or an
+    # asyncio task) with its own Q rows. Packets are forwarded between actors as messages, and every hop sends the
+    # node's estimate of the hops left back to the node the packet came from, which moves its Q value towards one hop
+    # more than that. Unlike QRouting there's no backward pass, since no actor sees a packet's whole path. The actors
+    # are started by the first packets and keep running between calls until close. Waiting for them gives up after
+    # timeout seconds without a message (never by default), or as soon as one of them fails
+    def __init__(self, mapfile, topology, epsilon=0.05, alpha=0.9, partitions=None, backend=PROCESSES,
+                 precision=NetworkMdp.FULL, timeout=None, seed=None):
+        self.network = NetworkMdp.make_network(mapfile, topology, precision)
+
+        # Q estimates the number of hops to the destination after taking action a
+        self.q = self.network.new_table(10000, NetworkMdp.value_dtypes[precision])
+
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.backend = backend
+        self.timeout = timeout
+        if partitions is None:
+            partitions = os.cpu_count() or 1
+        self.bounds = partition_bounds(self.network.nodes.shape, partitions)
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.selector = ActionSelector.ActionSelector(self.seed_sequence.spawn(1)[0])
+
+        # Running actors, and the max_hops, node map and Q table they were last given
+        self.routers = None
+        self.router_max_hops = None
+        self.router_nodes = None
+        self.router_q = None
+
+        # Packet hops and estimates sent so far, within partitions and between them
+        self.counts = dict.fromkeys(["packets", "remote_packets", "estimates", "remote_estimates"], 0)
+
+    def start_routers(self, max_hops):
+        seeds = self.seed_sequence.spawn(len(self.bounds) - 1)
+        actors = [RouterActor(index, self.bounds, self.network, self.q, self.epsilon, self.alpha, max_hops, seeds[index])
+                  for index in range(len(self.bounds) - 1)]
+        self.routers = (TaskRouters if self.backend == TASKS else ProcessRouters)(actors, self.timeout)
+        self.router_max_hops = max_hops
+        self.router_nodes = self.network.nodes.copy()
+        self.router_q = self.q
+
+    # UPDATE messages for every partition if max_hops, the node map (e.g. nodes failing) or the Q table (e.g. from a
+    # checkpoint) changed since the actors were last given them, otherwise None
+    def router_updates(self, max_hops):
+        network_changed = not np.array_equal(self.router_nodes, self.network.nodes)
+        q_changed = self.q is not self.router_q
+        if max_hops == self.router_max_hops and not network_changed and not q_changed:
+            return None
+
+        updates = []
+        link_starts = self.network.link_starts
+        for index in range(len(self.bounds) - 1):
+            first = self.bounds[index]
+            last = self.bounds[index + 1]
+            links = np.s_[link_starts[first]:link_starts[last]]
+
+            nodes = transitions = q = None
+            if network_changed:
+                nodes = self.network.nodes.ravel()[first:last].copy()
+                transitions = self.network.transitions.reshape(-1)[links].copy()
+            if q_changed:
+                q = np.array(self.q.reshape(-1)[links])
+            updates.append((UPDATE, max_hops if max_hops != self.router_max_hops else None, nodes, transitions, q))
+
+        self.router_max_hops = max_hops
+        self.router_nodes = self.network.nodes.copy()
+        self.router_q = self.q
+        return updates
+
+    # Route packets from the given origins (an array of [row, col]) through the actors, with up to window packets in
+    # flight at a time (all of them by default). Returns the number of hops of every packet, like QRouting.send_packets
+    def send_packets(self, origins, max_hops=100, window=None):
+        origins = np.asarray(origins)
+        flat_origins = origins[:, 0] * self.network.nodes.shape[1] + origins[:, 1]
+
+        if self.routers is None:
+            self.start_routers(max_hops)
+            updates = None
+        else:
+            updates = self.router_updates(max_hops)
+        coordinator = Coordinator(self.bounds, flat_origins, window or max(len(origins), 1), updates)
+
+        try:
+            messages = coordinator.start()
+            while True:
+                for destination, message in messages:
+                    self.routers.put(destination, message)
+                if coordinator.finished:
+                    break
+                messages = coordinator.receive(self.routers.get())
+        except BaseException:
+            # The actors may be part way through the round, so start again with new ones from the last Q rows collected
+            self.close()
+            raise
+
+        # Put the learned rows back together and route with them
+        q = self.q.reshape(-1)
+        link_starts = self.network.link_starts
+        for index, (rows, counts) in enumerate(coordinator.tables):
+            q[link_starts[self.bounds[index]]:link_starts[self.bounds[index + 1]]] = rows
+            for kind, count in counts.items():
+                self.counts[kind] = self.counts[kind] + count
+        self.greedy_policy()
+
+        return coordinator.hops
+
+    # Route a single packet, like QRouting.send_packet, so TrafficGenerator can drive the actors. Every call is a round
+    # of its own, use send_packets to route many packets at once
+    def send_packet(self, origin, max_hops=100):
+        return int(self.send_packets([origin], max_hops)[0])
+
+    # Epsilon-greedy action for the node with the Q rows collected after the last round
+    def get_action(self, node):
+        return self.selector.select(self.network.row(self.q, node), self.epsilon, minimize=True)
+
+    # Set the network policy of every node to the action with the lowest Q estimate
+    def greedy_policy(self):
+        self.network.policies[...] = self.network.best_links(self.q, minimize=True)
+
+    # Stop the actors, the next packets start new ones
+    def close(self):
+        if self.routers is not None:
+            routers = self.routers
+            self.routers = None
+            routers.close()
+
+
+def main(mapfile="mesh4x4.txt", topology=NetworkMdp.TORUS, packet_count=10000, plot=True, partitions=None,
+         backend=PROCESSES):
+    qroute = DistributedQRouting(mapfile, topology, partitions=partitions, backend=backend)
+    try:
+        traffic = TrafficGenerator.TrafficGenerator(qroute)
+        metrics = traffic.simulate(packet_count, "Distributed Q-Routing", False, plot=plot)
+    finally:
+        qroute.close()
+
+    print(f"Messages: {qroute.counts}")
+    return metrics
+
+
+if __name__ == '__main__':
+    main()
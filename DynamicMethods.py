@@ -1,15 +1,49 @@
+import heapq
 import numpy as np
 import NetworkMdp
+import ParallelValueIteration
 import TrafficGenerator
 
 
 class DynamicMethods:
 
-    def __init__(self, mapfile, topology):
-        self.network = NetworkMdp.NetworkMdp(mapfile, topology)
+    def __init__(self, mapfile, topology, vectorized=False, seed=None, precision=NetworkMdp.FULL, linear_eval=False,
+                 prioritized=False, workers=None, tiles=None):
+        self.network = NetworkMdp.make_network(mapfile, topology, precision)
+
+        # Vectorized solvers update the whole value array per sweep with NumPy array operations instead of
+        # looping over every node in Python
+        self.vectorized = vectorized
+
+        # Evaluate policies by solving their linear system directly instead of sweeping
+        self.linear_eval = linear_eval
+
+        # Value iteration only backs up the nodes that can still change, largest Bellman error first, instead of
+        # sweeping the whole network
+        self.prioritized = prioritized
+
+        # Value iteration splits the grid into tiles[0] x tiles[1] tiles (one per worker by default), or a graph into as
+        # many contiguous node ranges, swept in parallel by this many worker processes, see ParallelValueIteration
+        self.workers = workers
+        self.tiles = tiles
+
+        # Random number generator used to break ties between equally good actions
+        self.rng = np.random.default_rng(seed)
+
+        # Discount and convergence threshold of the last solve, which replan keeps using
+        self.discount = None
+        self.theta = None
 
     # Evaluate the chosen policy and update the value function for each state
     def policy_eval(self, discount, theta):
+        if self.linear_eval:
+            self.linear_policy_eval(discount, theta)
+            return
+
+        if self.vectorized:
+            self.vectorized_policy_eval(discount, theta)
+            return
+
         nabla = theta
         while nabla >= theta:
             max_diff = 0
@@ -21,10 +55,9 @@ class DynamicMethods:
 
                     if self.network.node(state) != NetworkMdp.INACTIVE:
                         old_value = old_values[state]
-                        action = NetworkMdp.actions[self.network.policy(state)]
 
                         # Loop through all the next possible states and calculate the total value function
-                        next_state, reward = self.network.next_node(state, action)
+                        next_state, reward = self.network.transition(state, self.network.policy(state))
                         self.network.values[state] = reward + discount * old_values[next_state]
                         max_diff = max(max_diff, abs(old_value - self.network.values[state]))
                     else:
@@ -33,6 +66,8 @@ class DynamicMethods:
 
     # Find the optimal policy using the policy iteration method
     def policy_iteration(self, discount, theta, max_k=15):
+        self.discount = discount
+        self.theta = theta
         for k in range(max_k):
             print("Iteration " + str(k))
 
@@ -41,37 +76,11 @@ class DynamicMethods:
 
             last_policy = np.copy(self.network.policies)
 
-            # Loop through each state
-            for x in range(0, self.network.nodes.shape[0]):
-                for y in range(0, self.network.nodes.shape[1]):
-                    state = (x, y)
-
-                    if self.network.node(state) != NetworkMdp.INACTIVE:
-                        # Now find the action(s) that maximize the value function
-                        max_value = float('-inf')
-                        best_a = []
-                        for action_id in NetworkMdp.actions.keys():
-                            action = NetworkMdp.actions[action_id]
-
-                            # Loop through all the next possible states and calculate the total value function
-                            next_state, reward = self.network.next_node(state, action)
-                            value = reward + discount * self.network.value(next_state)
-
-                            if value > max_value:
-                                # New maximum value found
-                                max_value = value
-                                best_a.clear()
-                                best_a.append(action_id)
-                            elif value == max_value:
-                                # This action has the same value as our current maximum, so this is an option as well
-                                best_a.append(action_id)
-
-                        if len(best_a) == 0:
-                            # No actions found that maximize the value function, randomly pick one for our policy
-                            self.network.set_policy(state, np.random.randint(0, 4))
-                        else:
-                            # Randomly pick an action from the best actions that maximized the value function
-                            self.network.set_policy(state, best_a[np.random.randint(0, len(best_a))])
+            # Improve the policy by acting greedily with respect to the new value function
+            if self.vectorized:
+                self.greedy_policy(discount, tolerance=theta)
+            else:
+                self.policy_improvement(discount)
 
             if (last_policy == self.network.policies).all():
                 # No change from the previous policy, we can stop here
@@ -80,8 +89,56 @@ class DynamicMethods:
 
             last_policy = np.copy(self.network.policies)
 
+    # Make the policy greedy with respect to the current value function
+    def policy_improvement(self, discount):
+        # Loop through each state
+        for x in range(0, self.network.nodes.shape[0]):
+            for y in range(0, self.network.nodes.shape[1]):
+                state = (x, y)
+
+                if self.network.node(state) != NetworkMdp.INACTIVE:
+                    # Now find the action(s) that maximize the value function
+                    max_value = float('-inf')
+                    best_a = []
+                    for action_id in range(self.network.degree(state)):
+                        # Loop through all the next possible states and calculate the total value function
+                        next_state, reward = self.network.transition(state, action_id)
+                        value = reward + discount * self.network.value(next_state)
+
+                        if value > max_value:
+                            # New maximum value found
+                            max_value = value
+                            best_a.clear()
+                            best_a.append(action_id)
+                        elif value == max_value:
+                            # This action has the same value as our current maximum, so this is an option as well
+                            best_a.append(action_id)
+
+                    if len(best_a) == 0:
+                        # No actions found that maximize the value function, randomly pick one for our policy
+                        self.network.set_policy(state, self.rng.integers(0, self.network.degree(state)))
+                    else:
+                        # Randomly pick an action from the best actions that maximized the value function
+                        self.network.set_policy(state, best_a[self.rng.integers(0, len(best_a))])
+
     # Find the optimal policy using the value iteration method
     def value_iteration(self, discount, theta):
+        self.discount = discount
+        self.theta = theta
+
+        if self.prioritized:
+            self.prioritized_value_iteration(discount, theta)
+            return
+
+        if self.workers is not None:
+            ParallelValueIteration.value_iteration(self.network, discount, theta, self.workers, self.tiles,
+                                                   int(self.rng.integers(2 ** 63)))
+            return
+
+        if self.vectorized:
+            self.vectorized_value_iteration(discount, theta)
+            return
+
         nabla = theta
         while nabla >= theta:
             max_diff = 0
@@ -97,11 +154,9 @@ class DynamicMethods:
                         # Now find the action(s) that maximize the value function
                         max_value = float('-inf')
                         best_a = []
-                        for action_id in NetworkMdp.actions.keys():
-                            action = NetworkMdp.actions[action_id]
-
+                        for action_id in range(self.network.degree(state)):
                             # Loop through all the next possible states and calculate the total value function
-                            next_state, reward = self.network.next_node(state, action)
+                            next_state, reward = self.network.transition(state, action_id)
                             value = reward + discount * self.network.value(next_state)
 
                             if value > max_value:
@@ -118,26 +173,239 @@ class DynamicMethods:
 
                         if len(best_a) == 0:
                             # No actions found that maximize the value function, randomly pick one for our policy
-                            self.network.set_policy(state, np.random.randint(0, 4))
+                            self.network.set_policy(state, self.rng.integers(0, self.network.degree(state)))
                         else:
                             # Randomly pick an action from the best actions that maximized the value function
-                            self.network.set_policy(state, best_a[np.random.randint(0, len(best_a))])
+                            self.network.set_policy(state, best_a[self.rng.integers(0, len(best_a))])
 
             nabla = max_diff
             print(nabla)
 
+    # Value of taking each action from every node, as a table with an entry per action (see NetworkMdp.link_starts)
+    def action_values(self, discount):
+        return self.network.rewards + discount * self.network.values.ravel()[self.network.transitions]
+
+    # Action that maximizes the action values q of every node, randomly picking between actions with the same value.
+    # If current actions are given, they're kept whenever they're within tolerance of the best value
+    def best_actions(self, q, current=None, tolerance=0.0):
+        # Give each action a random key and keep the action with the largest key among the best actions
+        max_q = self.network.best_values(q)
+        keys = self.rng.random(q.shape)
+        keys[q != self.network.per_link(max_q)] = -1
+
+        if current is not None:
+            links = self.network.flat_links(np.arange(self.network.nodes.size), current.ravel())
+            keep = q.ravel()[links] >= max_q.ravel() - tolerance
+            keys.reshape(-1)[links] = np.where(keep, 2, keys.reshape(-1)[links])
+
+        return self.network.best_links(keys)
+
+    # Entries of a table with an entry per action for the policy's action at every node, shaped like nodes
+    def policy_entries(self, table):
+        links = self.network.flat_links(np.arange(self.network.nodes.size), self.network.policies.ravel())
+        return table.ravel()[links].reshape(self.network.nodes.shape)
+
+    # Set the policy of every active node to an action that maximizes the value function, randomly picking
+    # between actions with the same value. With a tolerance, nodes keep their current action when it's within
+    # tolerance of the best one, so policy iteration can tell when the policy has stopped changing
+    def greedy_policy(self, discount, tolerance=None):
+        if tolerance is None:
+            best_a = self.best_actions(self.action_values(discount))
+        else:
+            best_a = self.best_actions(self.action_values(discount), self.network.policies, tolerance)
+
+        active = self.network.nodes != NetworkMdp.INACTIVE
+        self.network.policies[active] = best_a[active]
+
+    # Vectorized version of policy_eval, every node is updated at once from the previous sweep's values
+    def vectorized_policy_eval(self, discount, theta):
+        next_states = self.policy_entries(self.network.transitions)
+        rewards = self.policy_entries(self.network.rewards)
+        active = self.network.nodes != NetworkMdp.INACTIVE
+
+        nabla = theta
+        while nabla >= theta:
+            new_values = np.where(active, rewards + discount * self.network.values.ravel()[next_states], -1000)
+            nabla = np.max(np.abs(new_values - self.network.values), where=active, initial=0)
+            self.network.values[...] = new_values
+
+    # Evaluate the chosen policy by solving the sparse linear system V = R + discount * P V directly. The policy's
+    # transitions are deterministic, so P has a single 1 per row and is stored as the index of that column. Squaring P
+    # keeps that form, so the solution V = sum_k (discount * P)^k R is summed in log2(k) steps by repeated squaring
+    def linear_policy_eval(self, discount, theta):
+        active = self.network.nodes.ravel() != NetworkMdp.INACTIVE
+        next_states = self.policy_entries(self.network.transitions).ravel()
+        rewards = self.policy_entries(self.network.rewards).ravel().astype(float)
+
+        # Inactive nodes are never routed to, leave them out of the system
+        next_states[~active] = np.flatnonzero(~active)
+        rewards[~active] = 0
+
+        # After summing the first k terms, the rest add up to at most discount^k * max|R| / (1 - discount)
+        values = rewards
+        scale = discount
+        while scale * np.max(np.abs(rewards), initial=0) / (1 - discount) >= theta * (1 - discount):
+            values = values + scale * values[next_states]
+            next_states = next_states[next_states]
+            scale = scale * scale
+
+        self.network.values[...] = np.where(active, values, -1000).reshape(self.network.nodes.shape)
+
+    # Vectorized version of value_iteration, every node is updated at once from the previous sweep's values
+    def vectorized_value_iteration(self, discount, theta):
+        active = self.network.nodes != NetworkMdp.INACTIVE
+
+        nabla = theta
+        while nabla >= theta:
+            new_values = np.where(active, self.network.best_values(self.action_values(discount)), self.network.values)
+            nabla = np.max(np.abs(new_values - self.network.values), initial=0)
+            self.network.values[...] = new_values
+            print(nabla)
+
+        self.greedy_policy(discount)
+
+    # Asynchronous (Gauss-Seidel) version of value_iteration using prioritized sweeping. Nodes are backed up one at a time
+    # from a priority queue ordered by Bellman error, and a node is only queued again when one of the nodes it can route
+    # to has changed. Values start from the value of never reaching the destination, so updates spread backwards from
+    # the destination instead of every node being revisited on every sweep
+    def prioritized_value_iteration(self, discount, theta):
+        size = self.network.nodes.size
+        active = self.network.nodes.ravel() != NetworkMdp.INACTIVE
+        values = self.network.values.ravel()
+        values[active] = np.min(self.network.rewards) / (1 - discount)
+
+        # Only nodes that can reach the destination in one hop have any Bellman error to start with
+        errors = np.where(active, np.abs(self.network.best_values(self.action_values(discount)).ravel() - values), 0)
+        start = np.flatnonzero(errors >= theta)
+
+        # Plain Python lists are much faster than NumPy arrays for one node at a time, split into a list of entries per
+        # node
+        value_list = values.tolist()
+        bounds = list(zip(self.network.link_starts[:-1].tolist(), self.network.link_starts[1:].tolist()))
+        transitions = self.network.transitions.ravel().tolist()
+        transitions = [transitions[start:end] for start, end in bounds]
+        rewards = self.network.rewards.ravel().tolist()
+        rewards = [rewards[start:end] for start, end in bounds]
+        pred_indptr, pred_indices = [table.tolist() for table in self.network.reverse_transitions()]
+
+        priorities = [0.0] * size
+        queue = []
+        for node in start:
+            priorities[node] = errors[node]
+            queue.append((-errors[node], node))
+        heapq.heapify(queue)
+
+        backups = 0
+        while len(queue) > 0:
+            priority, node = heapq.heappop(queue)
+            if -priority != priorities[node]:
+                # Node was queued again with a larger error since this entry was added
+                continue
+
+            priorities[node] = 0.0
+            value_list[node] = max([r + discount * value_list[n] for r, n in zip(rewards[node], transitions[node])])
+            backups = backups + 1
+
+            # Queue the nodes whose Bellman error may have grown, including this node if it can stay in place
+            neighbours = pred_indices[pred_indptr[node]:pred_indptr[node + 1]]
+            if node in transitions[node]:
+                neighbours.append(node)
+
+            for neighbour in neighbours:
+                error = max([r + discount * value_list[n] for r, n in zip(rewards[neighbour], transitions[neighbour])])
+                error = abs(error - value_list[neighbour])
+                if error >= theta and error > priorities[neighbour]:
+                    priorities[neighbour] = error
+                    heapq.heappush(queue, (-error, neighbour))
+
+        print(f"{backups} backups")
+        self.network.values[...] = np.reshape(value_list, self.network.nodes.shape)
+        self.greedy_policy(discount)
+
+    # Flat indices of the nodes whose policy leads (over any number of hops) into one of the given flat nodes, including
+    # the nodes themselves
+    def policy_subtree(self, flat_nodes):
+        policies = self.network.policies.ravel()
+        in_subtree = np.zeros(self.network.nodes.size, bool)
+        in_subtree[flat_nodes] = True
+
+        subtree = [flat_nodes]
+        frontier = flat_nodes
+        while frontier.size > 0:
+            candidates = self.network.neighbours(frontier)
+            candidates = candidates[~in_subtree[candidates]]
+
+            # Follow each candidate's policy action, regardless of whether the node it leads to is still active
+            targets = self.network.action_targets(candidates, policies[candidates])
+
+            frontier = candidates[in_subtree[targets]]
+            in_subtree[frontier] = True
+            subtree.append(frontier)
+
+        return np.concatenate(subtree)
+
+    # Repair the value function and policy after the types of the given nodes have changed (e.g. nodes failing or
+    # recovering) instead of solving the whole network again. Only the region affected by the change is visited. The
+    # discount and theta default to the ones the network was solved with
+    def replan(self, changed_nodes, discount=None, theta=None):
+        if discount is None:
+            discount = self.discount
+        if theta is None:
+            theta = self.theta
+        if discount is None or theta is None:
+            raise ValueError("The network has to be solved before it can be replanned")
+        nodes = self.network.nodes.ravel()
+        values = self.network.values.ravel()
+        policies = self.network.policies.ravel()
+        transitions = self.network.transitions.ravel()
+        rewards = self.network.rewards.ravel()
+        changed = np.array([node[0] * self.network.nodes.shape[1] + node[1] for node in changed_nodes], np.int64)
+
+        # Nodes routing through a changed node can no longer trust their values. Reset them to the value of never
+        # reaching the destination so that, like the rest of the network, their values can only improve from here
+        affected = self.policy_subtree(changed)
+        affected = affected[nodes[affected] != NetworkMdp.INACTIVE]
+        values[affected] = np.min(rewards) / (1 - discount)
+
+        # Back up the affected nodes and the neighbours of the changed nodes (which may have new routes available),
+        # then keep spreading to the predecessors of every node whose value changed
+        frontier = np.union1d(affected, self.network.neighbours(changed))
+        while frontier.size > 0:
+            frontier = frontier[nodes[frontier] != NetworkMdp.INACTIVE]
+
+            links, counts = self.network.node_links(frontier)
+            q = rewards[links] + discount * values[transitions[links]]
+            new_values = NetworkMdp.segment_best(q, counts)
+            updated = frontier[np.abs(new_values - values[frontier]) >= theta]
+
+            # Randomly pick between the actions with the best value, like best_actions
+            keys = self.rng.random(q.shape)
+            keys[q != np.repeat(new_values, counts)] = -1
+            values[frontier] = new_values
+            policies[frontier] = NetworkMdp.segment_argbest(keys, counts)
+
+            # Nodes that can stay in place depend on their own value as well
+            links, counts = self.network.node_links(updated)
+            stays = transitions[links] == np.repeat(updated, counts)
+            stays = np.logical_or.reduceat(stays, NetworkMdp.segment_starts(counts))
+            frontier = np.union1d(self.network.predecessors(updated), updated[stays])
+
     def send_packet(self, origin, max_hops=100):
         return self.network.send_packet(origin, max_hops)
 
+    # Action the policy takes at a node
+    def get_action(self, node):
+        return int(self.network.policy(node))
+
 
-def main():
+def main(mapfile="mesh4x4.txt", topology=NetworkMdp.TORUS, packet_count=10000, plot=True):
     # Find the optimal policy using value iteration
-    dp = DynamicMethods("mesh4x4.txt", NetworkMdp.TORUS)
+    dp = DynamicMethods(mapfile, topology)
     dp.value_iteration(0.9, 0.001)
 
     # Generate random traffic
     traffic = TrafficGenerator.TrafficGenerator(dp)
-    traffic.simulate(10000, "Value Iteration", True)
+    return traffic.simulate(packet_count, "Value Iteration", True, plot=plot)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,272 @@
+import numpy as np
+import NetworkMdp
+
+
+# Positions indptr[v] to indptr[v + 1] - 1 of a compressed sparse row array for every v in rows, row after row
+def row_offsets(indptr, rows):
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+
+
+# Concatenation of rows indices[indptr[v]:indptr[v + 1]] of a compressed sparse row array for every v in rows
+def gather(indptr, indices, rows):
+    return indices[row_offsets(indptr, rows)]
+
+
+# Compressed sparse row adjacency [indptr, indices] of size nodes from an array of [from, to] edges. Undirected edges
+# are added in both directions
+def from_edges(edges, size=None, undirected=True):
+    edges = np.asarray(edges, np.int64).reshape(-1, 2)
+    if undirected:
+        edges = np.concatenate([edges, edges[:, ::-1]])
+    if size is None:
+        size = int(np.max(edges)) + 1 if edges.size > 0 else 0
+
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    indptr = np.zeros(size + 1, np.int64)
+    np.cumsum(np.bincount(edges[:, 0], minlength=size), out=indptr[1:])
+
+    return [indptr, edges[:, 1].astype(np.int32)]
+
+
+# Adjacency of a graph from a text file with a "from to" edge per line
+def load_edges(filename, size=None, undirected=True):
+    return from_edges(np.loadtxt(filename, np.int64, ndmin=2), size, undirected)
+
+
+# Adjacency of a k-ary fat-tree (k even): (k / 2)^2 core switches, then k pods of k / 2 aggregation and k / 2 edge
+# switches each, then k / 2 hosts on every edge switch. Every edge switch links to every aggregation switch in its pod,
+# and aggregation switch j of every pod links to core switches j * k / 2 to (j + 1) * k / 2 - 1
+def fat_tree(k):
+    half = k // 2
+    cores = half * half
+    aggregation = cores + np.arange(k * half).reshape(k, half)
+    edge = cores + k * half + np.arange(k * half).reshape(k, half)
+    hosts = cores + 2 * k * half + np.arange(k * half * half).reshape(k, half, half)
+
+    host_edges = np.stack([np.broadcast_to(edge[:, :, np.newaxis], hosts.shape), hosts], axis=-1)
+    pod_edges = np.stack(np.broadcast_arrays(edge[:, :, np.newaxis], aggregation[:, np.newaxis, :]), axis=-1)
+    core_edges = np.stack(np.broadcast_arrays(aggregation[:, :, np.newaxis],
+                                              np.arange(cores).reshape(half, half)[np.newaxis]), axis=-1)
+
+    edges = np.concatenate([host_edges.reshape(-1, 2), pod_edges.reshape(-1, 2), core_edges.reshape(-1, 2)])
+    return from_edges(edges, cores + 2 * k * half + k * half * half)
+
+
+# Adjacency of a dragonfly: groups of fully connected routers, with hosts on every router and one global link between
+# every pair of groups, spread evenly over the routers of each group
+def dragonfly(groups, routers, hosts=1):
+    router_ids = np.arange(groups * routers).reshape(groups, routers)
+    host_ids = groups * routers + np.arange(groups * routers * hosts).reshape(groups, routers, hosts)
+
+    local = np.triu_indices(routers, 1)
+    local_edges = np.stack([router_ids[:, local[0]], router_ids[:, local[1]]], axis=-1)
+    host_edges = np.stack([np.broadcast_to(router_ids[:, :, np.newaxis], host_ids.shape), host_ids], axis=-1)
+
+    # Group g uses its routers in turn for its links to the other groups, in order of group
+    first, second = np.triu_indices(groups, 1)
+    first_router = (second - 1) % routers
+    second_router = first % routers
+    global_edges = np.stack([router_ids[first, first_router], router_ids[second, second_router]], axis=-1)
+
+    edges = np.concatenate([local_edges.reshape(-1, 2), host_edges.reshape(-1, 2), global_edges])
+    return from_edges(edges, groups * routers * (hosts + 1))
+
+
+# Adjacency of an irregular graph: a ring (so every node is reachable) plus links from every node to degree - 2 random
+# other nodes
+def random_graph(size, degree=4, seed=None):
+    rng = np.random.default_rng(seed)
+    nodes = np.arange(size)
+    ring = np.stack([nodes, (nodes + 1) % size], axis=-1)
+
+    extra = max(degree - 2, 0) * size // 2
+    random_edges = rng.integers(0, size, (extra, 2))
+    random_edges = random_edges[random_edges[:, 0] != random_edges[:, 1]]
+
+    # Drop duplicate links
+    edges = np.sort(np.concatenate([ring, random_edges]), axis=-1)
+    keys = np.unique(edges[:, 0] * size + edges[:, 1])
+    return from_edges(np.stack(np.divmod(keys, size), axis=-1), size)
+
+
+class GraphNetworkMdp(NetworkMdp.NetworkMdp):
+    # Network on a directed graph in compressed sparse row form: a packet at node v can be forwarded to the nodes
+    # indices[indptr[v]:indptr[v + 1]], and forwarding to the k-th of them is action k. Nodes are stored as a single
+    # column so they can still be addressed as (row, col) = (v, 0). Tables with an entry per action are flat, with one
+    # entry per link, and the entries of node v are table[link_starts[v]:link_starts[v + 1]]
+    def __init__(self, indptr, indices, destination, node_types=None, precision=NetworkMdp.FULL, name=None):
+        self.precision = precision
+        self.indptr = np.asarray(indptr, np.int64)
+        self.indices = np.asarray(indices, np.int32)
+        size = len(self.indptr) - 1
+
+        self.nodes = np.zeros((size, 1), NetworkMdp.node_dtypes[precision])
+        if node_types is not None:
+            self.nodes[:, 0] = node_types
+        self.nodes[destination, 0] = NetworkMdp.DESTINATION
+
+        # Nodes without any links can only hold on to a packet, which is their one action
+        link_counts = np.diff(self.indptr)
+        self.degrees = np.maximum(link_counts, 1).astype(np.int32)
+        self.action_count = int(np.max(self.degrees, initial=1))
+        self.link_starts = np.zeros(size + 1, np.int64)
+        np.cumsum(self.degrees, out=self.link_starts[1:])
+
+        # Node at the other end of every link, regardless of its type
+        origins = np.repeat(np.arange(size), link_counts)
+        self.link_targets = np.repeat(np.arange(size, dtype=np.int32), self.degrees)
+        link_offsets = np.arange(self.indices.size) - self.indptr[origins]
+        self.link_targets[self.link_starts[origins] + link_offsets] = self.indices
+
+        # Reverse links: the nodes with a link to node v are reverse_indices[reverse_indptr[v]:reverse_indptr[v + 1]]
+        order = np.argsort(self.indices, kind="stable")
+        self.reverse_indices = origins[order].astype(np.int32)
+        self.reverse_indptr = np.zeros(size + 1, np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=size), out=self.reverse_indptr[1:])
+
+        self.values = np.zeros(self.nodes.shape, NetworkMdp.value_dtypes[precision])
+        self.policies = (np.random.random(self.nodes.shape) * self.degrees[:, np.newaxis]).astype(
+            NetworkMdp.policy_dtype(precision, self.action_count))
+        self.topology = NetworkMdp.GRAPH
+        self.mapfile = name
+
+        self.transitions = None
+        self.rewards = None
+        self.build_transitions()
+
+    # Plot the network with its nodes on a circle: every link in grey and the link each active node's policy takes in
+    # red, inactive nodes in black and the destination in green
+    def render(self, method, filename):
+        # Only pay for importing bokeh when something is rendered
+        from bokeh.plotting import figure, save, show
+
+        size = self.nodes.shape[0]
+        angles = 2 * np.pi * np.arange(size) / max(size, 1)
+        x_pos = np.cos(angles)
+        y_pos = np.sin(angles)
+
+        nodes = self.nodes[:, 0]
+        color = np.where(nodes == NetworkMdp.INACTIVE, "#000000",
+                         np.where(nodes == NetworkMdp.DESTINATION, "#00FF00", "#FFFFFF"))
+
+        origins = np.repeat(np.arange(size), np.diff(self.indptr))
+        active = np.flatnonzero(nodes == NetworkMdp.ACTIVE)
+        targets = self.action_targets(active, self.policies[active, 0])
+
+        fig = figure(title=f"{method}: Network Policy", match_aspect=True)
+        fig.segment(x_pos[origins], y_pos[origins], x_pos[self.indices], y_pos[self.indices], color="#CCCCCC")
+        fig.segment(x_pos[active], y_pos[active], x_pos[targets], y_pos[targets], color="#FF0000", alpha=0.5,
+                    line_width=2)
+        fig.scatter(x_pos, y_pos, fill_color=color.tolist(), line_color="#000000", size=8)
+
+        save(fig, filename)
+        show(fig)
+
+    # Given a current node and an action id, return the next node and the given reward
+    def next_node(self, current_node, action):
+        return self.transition(current_node, action)
+
+    def action_targets(self, flat_nodes, action_ids):
+        return self.link_targets[self.flat_links(flat_nodes, action_ids)]
+
+    def link(self, node, action):
+        return self.link_starts[node[0]] + action
+
+    def flat_links(self, flat_nodes, action_ids):
+        return self.link_starts[flat_nodes] + action_ids
+
+    def row(self, table, node):
+        return table[self.link_starts[node[0]]:self.link_starts[node[0] + 1]]
+
+    def node_links(self, flat_nodes):
+        flat_nodes = np.asarray(flat_nodes, np.int64)
+        return [row_offsets(self.link_starts, flat_nodes), self.degrees[flat_nodes]]
+
+    def new_table(self, value, dtype):
+        return np.full(self.link_targets.size, value, dtype)
+
+    def best_values(self, table, minimize=False):
+        return NetworkMdp.segment_best(table, self.degrees, minimize).reshape(self.nodes.shape)
+
+    def best_links(self, table, minimize=False):
+        return NetworkMdp.segment_argbest(table, self.degrees, minimize).reshape(self.nodes.shape)
+
+    def per_link(self, node_values):
+        return np.repeat(node_values.ravel(), self.degrees)
+
+    # Next node and reward for the given links (indices into the tables)
+    def link_transitions(self, links):
+        nodes = self.nodes.ravel()
+        next_nodes = self.link_targets[links]
+
+        # Can't route to inactive nodes, stay in the current state
+        origins = np.searchsorted(self.link_starts, links, side="right") - 1
+        next_nodes = np.where(nodes[next_nodes] == NetworkMdp.INACTIVE, origins, next_nodes)
+
+        # Reward is -1 unless the action takes us to the goal (in which case the reward is 0)
+        rewards = np.where(nodes[next_nodes] == NetworkMdp.DESTINATION, 0, -1)
+
+        return [next_nodes, rewards]
+
+    def build_transitions(self):
+        next_nodes, rewards = self.link_transitions(np.arange(self.link_targets.size))
+        self.transitions = next_nodes.astype(np.int32)
+        self.rewards = rewards.astype(np.int8)
+
+    # Rebuild the transitions of the node and every node with a link to it
+    def update_transitions(self, node):
+        flat_nodes = np.append(gather(self.reverse_indptr, self.reverse_indices, np.array([node[0]])), node[0])
+        links = self.node_links(flat_nodes)[0]
+        self.transitions[links], self.rewards[links] = self.link_transitions(links)
+
+    # Nodes with a link to any of the given (flat) nodes, regardless of their type
+    def neighbours(self, flat_nodes):
+        flat_nodes = np.asarray(flat_nodes, np.int64)
+        neighbours = gather(self.reverse_indptr, self.reverse_indices, flat_nodes).astype(np.int64)
+        targets = np.repeat(flat_nodes, np.diff(self.reverse_indptr)[flat_nodes])
+        return np.unique(neighbours[neighbours != targets])
+
+    # Flat indices of the active nodes that can route to any of the given (flat) nodes in one hop
+    def predecessors(self, flat_nodes):
+        flat_nodes = np.asarray(flat_nodes, np.int64)
+        candidates = gather(self.reverse_indptr, self.reverse_indices, flat_nodes).astype(np.int64)
+        targets = np.repeat(flat_nodes, np.diff(self.reverse_indptr)[flat_nodes])
+
+        links, counts = self.node_links(candidates)
+        routes_there = self.transitions[links] == np.repeat(targets, counts)
+        is_predecessor = np.logical_or.reduceat(routes_there, NetworkMdp.segment_starts(counts))
+        is_predecessor &= (candidates != targets) & (self.nodes.ravel()[candidates] != NetworkMdp.INACTIVE)
+        return np.unique(candidates[is_predecessor])
+
+    # NetworkMdp.send_packet through the per-link tables, where a node's links start at its link_starts entry
+    def send_packet(self, origin, max_hops=100):
+        if self.node(origin) == NetworkMdp.INACTIVE:
+            return NetworkMdp.TIMEOUT
+
+        nodes = self.nodes.ravel()
+        policies = self.policies.ravel()
+
+        hops = 0
+        current_node = origin[0]
+        while nodes[current_node] != NetworkMdp.DESTINATION:
+            current_node = self.transitions[self.link_starts[current_node] + policies[current_node]]
+            hops = hops + 1
+
+            if hops > max_hops:
+                return NetworkMdp.TIMEOUT
+
+        return hops
+
+
+def main():
+    for name, (indptr, indices) in [("Fat-tree (k = 4)", fat_tree(4)), ("Dragonfly (9 groups of 4)", dragonfly(9, 4)),
+                                    ("Random graph (1000 nodes)", random_graph(1000, seed=0))]:
+        network = GraphNetworkMdp(indptr, indices, destination=len(indptr) - 2)
+        print(f"{name}: {network.nodes.size} nodes, {indices.size} links, "
+              f"up to {network.action_count} actions per node, {network.transitions.size} table entries")
+
+
+if __name__ == '__main__':
+    main()
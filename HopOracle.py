@@ -0,0 +1,76 @@
+import numpy as np
+import NetworkMdp
+
+
+class HopOracle:
+    def __init__(self, network, all_pairs=False):
+        self.network = network
+        self.all_pairs = all_pairs
+
+        # Predecessors of every node in compressed sparse row form: the nodes that can route to node v in one hop are
+        # pred_indices[pred_indptr[v]:pred_indptr[v + 1]]
+        self.pred_indptr = None
+        self.pred_indices = None
+
+        # Optimal number of hops from every node to the network's destination
+        self.distances = None
+
+        # Optimal number of hops between every pair of nodes, indexed by the flat [destination, origin] nodes
+        self.all_distances = None
+
+        self.update()
+
+    # Recompute the distances, e.g. after nodes in the network have been set active or inactive
+    def update(self):
+        self.build_predecessors()
+
+        nodes = self.network.nodes.ravel()
+        self.distances = self.bfs(np.flatnonzero(nodes == NetworkMdp.DESTINATION)).reshape(self.network.nodes.shape)
+
+        if self.all_pairs:
+            # Distances fit in 16 bits as long as there are fewer nodes than the largest int16
+            dtype = np.int16 if nodes.size <= np.iinfo(np.int16).max else np.int32
+            self.all_distances = np.full((nodes.size, nodes.size), NetworkMdp.TIMEOUT, dtype)
+            for destination in np.flatnonzero(nodes != NetworkMdp.INACTIVE):
+                self.all_distances[destination] = self.bfs([destination])
+
+    def build_predecessors(self):
+        self.pred_indptr, self.pred_indices = self.network.reverse_transitions()
+
+    # Breadth first search backwards from the given destination nodes (flat indices), one level at a time. Returns the
+    # number of hops from every node to the closest destination, or TIMEOUT if it can't reach one
+    def bfs(self, destinations):
+        distances = np.full(self.network.nodes.size, NetworkMdp.TIMEOUT, np.int32)
+        frontier = np.asarray(destinations, np.int64)
+
+        # Packets can't be delivered to inactive nodes
+        frontier = frontier[self.network.nodes.ravel()[frontier] != NetworkMdp.INACTIVE]
+        distances[frontier] = 0
+
+        hops = 0
+        while frontier.size > 0:
+            hops = hops + 1
+
+            # Gather the predecessors of every node in the frontier
+            starts = self.pred_indptr[frontier]
+            counts = self.pred_indptr[frontier + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+            predecessors = self.pred_indices[offsets]
+
+            frontier = np.unique(predecessors[distances[predecessors] == NetworkMdp.TIMEOUT])
+            distances[frontier] = hops
+
+        return distances
+
+    # Optimal number of hops from the origin to the destination (the network's destination by default), or TIMEOUT
+    # if the packet can't get there
+    def distance(self, origin, destination=None):
+        if destination is None:
+            return int(self.distances[origin[0], origin[1]])
+
+        width = self.network.nodes.shape[1]
+        if self.all_distances is None:
+            # No all-pairs table, search from this destination instead
+            return int(self.bfs([destination[0] * width + destination[1]])[origin[0] * width + origin[1]])
+
+        return int(self.all_distances[destination[0] * width + destination[1], origin[0] * width + origin[1]])
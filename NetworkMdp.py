@@ -1,5 +1,4 @@
 import numpy as np
-from bokeh.plotting import figure, save, show
 
 # Types of nodes in the network
 DESTINATION = -1    # Destination of our packet
@@ -15,6 +14,7 @@ DOWN = 3
 # Network topology
 MESH = 0
 TORUS = 1
+GRAPH = 2   # Arbitrary graph, see GraphNetworkMdp
 
 actions = {
     RIGHT: [0, 1],
@@ -23,19 +23,133 @@ actions = {
     DOWN: [-1, 0]
 }
 
+# Look up an action's id from its [row, col] offset
+action_ids = {tuple(action): action_id for action_id, action in actions.items()}
+
+# [row, col] offset of every action, indexed by action id
+action_offsets = np.array([actions[action_id] for action_id in sorted(actions.keys())])
+
 TIMEOUT = -1
 
+# Storage precision for the network and learner tables
+FULL = 0        # float64 node types and values, int64 policies
+COMPACT = 1     # int8 node types, uint8 policies, float32 values (and Q/confidence tables in the learners)
+
+node_dtypes = {FULL: np.float64, COMPACT: np.int8}
+policy_dtypes = {FULL: np.int64, COMPACT: np.uint8}
+value_dtypes = {FULL: np.float64, COMPACT: np.float32}
+
+# Policy dtype for a network with up to action_count actions at a node, which has to be wider than the precision's
+# policy dtype when more actions than it can hold are possible
+def policy_dtype(precision, action_count):
+    return np.promote_types(policy_dtypes[precision], np.min_scalar_type(max(action_count - 1, 0)))
+
+
+# Start of every segment when an array is split into segments of the given (non-zero) lengths
+def segment_starts(counts):
+    return np.cumsum(counts) - counts
+
+
+# Largest (or smallest, with minimize) value of every segment of the given (non-zero) lengths
+def segment_best(values, counts, minimize=False):
+    reduce = np.minimum if minimize else np.maximum
+    return reduce.reduceat(values, segment_starts(counts))
+
+
+# Index within its segment of the first largest (or smallest, with minimize) value of every segment
+def segment_argbest(values, counts, minimize=False):
+    starts = segment_starts(counts)
+    best = np.flatnonzero(values == np.repeat(segment_best(values, counts, minimize), counts))
+    segments = np.searchsorted(starts, best, side="right") - 1
+    first = np.flatnonzero(np.diff(segments, prepend=-1))
+    return best[first] - starts[segments[first]]
+
+
+# Bytes that can appear in a map text file the fast path can parse: space separated single digit node types
+map_text_bytes = np.zeros(256, bool)
+map_text_bytes[list(b" \t\r\n-0123456789")] = True
+
+
+# Load a map of node types, either binary (.npy, int8 node types) or space separated text
+def load_map(map_file):
+    if map_file.endswith(".npy"):
+        return np.load(map_file)
+
+    with open(map_file, "rb") as file:
+        data = np.frombuffer(file.read(), np.uint8)
+
+    # Parse the text with array operations when every node type is a single (possibly negative) digit, which is the
+    # case for every map with the node types above
+    digits = np.flatnonzero((data >= ord("0")) & (data <= ord("9")))
+    if np.all(map_text_bytes[data]) and not np.any(np.diff(digits) == 1) and digits.size > 0:
+        nodes = (data[digits] - ord("0")).astype(np.int8)
+        negative = np.zeros(digits.size, bool)
+        negative[digits > 0] = data[digits[digits > 0] - 1] == ord("-")
+        nodes[negative] = -nodes[negative]
+
+        # Blank lines don't count as rows. Ragged rows are left to np.loadtxt, which rejects them
+        lines = np.cumsum(data == ord("\n"))[digits]
+        counts = np.unique(lines, return_counts=True)[1]
+        if np.all(counts == counts[0]):
+            return nodes.reshape(counts.size, -1)
+
+    return np.loadtxt(map_file, delimiter=" ", ndmin=2)
+
+
+# Save a map of node types, binary if the file name ends in .npy and space separated text otherwise
+def save_map(nodes, map_file):
+    if map_file.endswith(".npy"):
+        np.save(map_file, np.asarray(nodes).astype(np.int8))
+    else:
+        np.savetxt(map_file, nodes, fmt="%d", delimiter=" ")
+
+
+# Generate a rows x cols map where each node is inactive with probability failure_density. The destination (random by
+# default) is always set
+def generate_map(rows, cols, failure_density=0.0, destination=None, seed=None):
+    rng = np.random.default_rng(seed)
+    nodes = np.where(rng.random((rows, cols)) < failure_density, INACTIVE, ACTIVE).astype(np.int8)
+
+    if destination is None:
+        destination = (rng.integers(rows), rng.integers(cols))
+    nodes[destination[0], destination[1]] = DESTINATION
+
+    return nodes
+
 
 class NetworkMdp:
-    def __init__(self, map_file, topology):
-        self.nodes = np.loadtxt(open(map_file, "rb"), delimiter=" ")
-        self.values = np.zeros(self.nodes.shape)
-        self.policies = np.random.randint(0, 4, self.nodes.shape)
+    # map_file is the name of a map file (see load_map) or an array of node types, e.g. from generate_map
+    def __init__(self, map_file, topology, precision=FULL):
+        self.precision = precision
+        if isinstance(map_file, str):
+            self.nodes = load_map(map_file).astype(node_dtypes[precision])
+        else:
+            self.nodes = np.array(map_file, node_dtypes[precision], ndmin=2)
+        self.values = np.zeros(self.nodes.shape, value_dtypes[precision])
+        self.policies = np.random.randint(0, 4, self.nodes.shape).astype(policy_dtypes[precision])
         self.topology = topology
         self.mapfile = map_file
 
+        # Most actions at any node, and the number of them available at every (flat) node. Grids have the same four
+        # actions everywhere, graphs can have a different number at every node
+        self.action_count = len(actions)
+        self.degrees = np.full(self.nodes.size, len(actions), np.int32)
+
+        # Tables with an entry per action of every node (transitions, rewards and the learners' Q tables) have shape
+        # (rows, cols, actions) on grids. The entries of (flat) node v are
+        # table.ravel()[link_starts[v]:link_starts[v + 1]]
+        self.link_starts = np.arange(0, self.nodes.size * len(actions) + 1, len(actions))
+
+        # Next node (as a flat index into nodes.ravel()) and reward for every node and action, shape (rows, cols, actions)
+        self.transitions = None
+        self.rewards = None
+        self.build_transitions()
+
     # Plot the network and its policies
     def render(self, method, filename):
+        # Only pay for importing bokeh when something is rendered
+        from bokeh.plotting import figure, save, show
+
         x_pos = []
         y_pos = []
         color = []
@@ -78,33 +192,167 @@ class NetworkMdp:
 
     # Given a current node and an action taken, return the next node and the given reward
     def next_node(self, current_node, action):
-        next_node = (current_node[0] + action[0], current_node[1] + action[1])
+        return self.transition(current_node, action_ids[tuple(action)])
+
+    # Given a current node and an action id, look up the next node and the given reward in the transition table
+    def transition(self, current_node, action):
+        link = self.link(current_node, action)
+        return [divmod(int(self.transitions[link]), self.nodes.shape[1]), int(self.rewards[link])]
+
+    # Index of the entry for the action at the node in a table with an entry per action (see link_starts), which is a
+    # (row, col, action) tuple on grids
+    def link(self, node, action):
+        return node[0], node[1], action
+
+    # Indices into table.ravel() of the entries for the given flat nodes and actions
+    def flat_links(self, flat_nodes, action_ids):
+        return flat_nodes * self.action_count + action_ids
+
+    # Entries of the node's actions in a table with an entry per action, as a view
+    def row(self, table, node):
+        return table[node[0], node[1]]
+
+    # Indices into table.ravel() of the entries of every action of the given flat nodes, node after node, along with
+    # the number of actions of every node
+    def node_links(self, flat_nodes):
+        flat_nodes = np.asarray(flat_nodes, np.int64)
+        links = flat_nodes[:, np.newaxis] * self.action_count + np.arange(self.action_count)
+        return [links.ravel(), np.full(flat_nodes.size, self.action_count)]
+
+    # New table with an entry per action of every node, all set to value
+    def new_table(self, value, dtype):
+        return np.full(self.transitions.shape, value, dtype)
+
+    # Largest (or smallest, with minimize) entry of every node in a table with an entry per action, shaped like nodes
+    def best_values(self, table, minimize=False):
+        return np.min(table, axis=-1) if minimize else np.max(table, axis=-1)
+
+    # Action with the first largest (or smallest, with minimize) entry of every node, shaped like nodes
+    def best_links(self, table, minimize=False):
+        return np.argmin(table, axis=-1) if minimize else np.argmax(table, axis=-1)
+
+    # Values of the nodes (shaped like nodes) repeated for every action of the node, to compare against a table
+    def per_link(self, node_values):
+        return node_values[..., np.newaxis]
+
+    # Node reached from the nodes at the given rows and cols (every node in the network by default) by taking the
+    # action, regardless of the type of that node. Returns flat indices into nodes.ravel()
+    def adjacent_nodes(self, action, rows=None, cols=None):
+        if rows is None:
+            rows, cols = np.indices(self.nodes.shape)
+        next_rows = rows + action[0]
+        next_cols = cols + action[1]
 
         if self.topology == MESH:
-            if not self.in_bounds(next_node):
-                # Can't route off of the network (no node exists here), stay in the current state
-                next_node = current_node
-        elif self.topology == TORUS:
+            # Can't route off of the network (no node exists here), stay in the current state
+            in_bounds = (next_rows >= 0) & (next_rows < self.nodes.shape[0]) & (next_cols >= 0) & (next_cols < self.nodes.shape[1])
+            return np.where(in_bounds, next_rows * self.nodes.shape[1] + next_cols, rows * self.nodes.shape[1] + cols)
+        else:
             # Torus topology, can wrap around the edges of the network
-            if next_node[0] < 0:
-                next_node = (self.nodes.shape[0] - 1, next_node[1])
-            elif next_node[0] >= self.nodes.shape[0]:
-                next_node = (0, next_node[1])
-            if next_node[1] < 0:
-                next_node = (next_node[0], self.nodes.shape[1] - 1)
-            elif next_node[1] >= self.nodes.shape[1]:
-                next_node = (next_node[0], 0)
-
-        if self.node(next_node) == INACTIVE:
-            # Can't route to this node (it's inactive), stay in the current state and exit
-            next_node = current_node
+            return (next_rows % self.nodes.shape[0]) * self.nodes.shape[1] + next_cols % self.nodes.shape[1]
+
+    # Vectorized version of next_node for the nodes at the given rows and cols (every node in the network by
+    # default). Returns the flat index (into nodes.ravel()) of the next node for each node, along with the reward
+    # for taking the action there
+    def next_nodes(self, action, rows=None, cols=None):
+        if rows is None:
+            rows, cols = np.indices(self.nodes.shape)
+        current = rows * self.nodes.shape[1] + cols
+        next_nodes = self.adjacent_nodes(action, rows, cols)
+
+        # Can't route to inactive nodes, stay in the current state
+        next_nodes = np.where(self.nodes.ravel()[next_nodes] == INACTIVE, current, next_nodes)
 
         # Reward is -1 unless the action takes us to the goal (in which case the reward is 0)
-        reward = -1
-        if self.node(next_node) == DESTINATION:
-            reward = 0
+        rewards = np.where(self.nodes.ravel()[next_nodes] == DESTINATION, 0, -1)
+
+        return [next_nodes, rewards]
+
+    # Node each of the given flat nodes is next to in the direction of the corresponding action id, regardless of the
+    # type of that node
+    def action_targets(self, flat_nodes, action_ids):
+        rows, cols = np.divmod(flat_nodes, self.nodes.shape[1])
+        return self.adjacent_nodes(action_offsets[action_ids].T, rows, cols)
+
+    # Number of actions available at a node, which are action ids 0 to degree - 1
+    def degree(self, node):
+        return self.degrees[node[0] * self.nodes.shape[1] + node[1]]
+
+    # Flat indices of the nodes next to any of the given (flat) nodes, regardless of their type
+    def neighbours(self, flat_nodes):
+        rows, cols = np.divmod(flat_nodes, self.nodes.shape[1])
+        neighbours = np.concatenate([self.adjacent_nodes(actions[action_id], rows, cols) for action_id in actions.keys()])
+        return np.unique(neighbours[neighbours != np.tile(flat_nodes, len(actions))])
+
+    # Flat indices of the active nodes that can route to any of the given (flat) nodes in one hop
+    def predecessors(self, flat_nodes):
+        rows, cols = np.divmod(flat_nodes, self.nodes.shape[1])
+        candidates = np.concatenate([self.adjacent_nodes(actions[action_id], rows, cols) for action_id in actions.keys()])
+        targets = np.tile(flat_nodes, len(actions))
 
-        return [next_node, reward]
+        transitions = self.transitions.reshape(self.nodes.size, -1)
+        is_predecessor = np.any(transitions[candidates] == targets[:, np.newaxis], axis=-1)
+        is_predecessor &= (candidates != targets) & (self.nodes.ravel()[candidates] != INACTIVE)
+        return np.unique(candidates[is_predecessor])
+
+    # Build the transition and reward tables for the whole network
+    def build_transitions(self):
+        transitions = [self.next_nodes(actions[action_id]) for action_id in actions.keys()]
+        self.transitions = np.stack([next_nodes for next_nodes, rewards in transitions], axis=-1).astype(np.int32)
+        self.rewards = np.stack([rewards for next_nodes, rewards in transitions], axis=-1).astype(np.int8)
+
+    # Rebuild the transition table entries that can depend on the type of the given node: the node itself (its
+    # reward for staying in place) and every node that can route to it
+    def update_transitions(self, node):
+        rows = np.array([node[0]] + [node[0] - action[0] for action in actions.values()])
+        cols = np.array([node[1]] + [node[1] - action[1] for action in actions.values()])
+
+        if self.topology == MESH:
+            in_bounds = (rows >= 0) & (rows < self.nodes.shape[0]) & (cols >= 0) & (cols < self.nodes.shape[1])
+            rows = rows[in_bounds]
+            cols = cols[in_bounds]
+        else:
+            rows = rows % self.nodes.shape[0]
+            cols = cols % self.nodes.shape[1]
+
+        for action_id in actions.keys():
+            next_nodes, rewards = self.next_nodes(actions[action_id], rows, cols)
+            self.transitions[rows, cols, action_id] = next_nodes
+            self.rewards[rows, cols, action_id] = rewards
+
+    # Invert the transition table into compressed sparse row form, ignoring actions that stay in place and inactive
+    # nodes (which can't forward packets). The nodes that can route to (flat) node v in one hop are
+    # indices[indptr[v]:indptr[v + 1]]
+    def reverse_transitions(self):
+        origins = np.repeat(np.arange(self.nodes.size), self.degrees)
+        next_nodes = self.transitions.ravel()
+
+        valid = (origins != next_nodes) & (self.nodes.ravel()[origins] != INACTIVE)
+        origins = origins[valid]
+        next_nodes = next_nodes[valid]
+
+        order = np.argsort(next_nodes, kind="stable")
+        indices = origins[order].astype(np.int32)
+        indptr = np.zeros(self.nodes.size + 1, np.int64)
+        np.cumsum(np.bincount(next_nodes, minlength=self.nodes.size), out=indptr[1:])
+
+        return [indptr, indices]
+
+    # Set the type of a node (e.g. destination, inactive, active) and patch the transition table around it
+    def set_node(self, node, node_type):
+        self.nodes[node[0], node[1]] = node_type
+        self.update_transitions(node)
+
+    # Replace the types of all nodes in the network, only patching the transition table around changed nodes
+    def set_nodes(self, nodes):
+        changed = np.argwhere(self.nodes != nodes)
+        self.nodes[...] = nodes
+        if len(changed) * (len(actions) + 1) > self.nodes.size:
+            # Cheaper to rebuild the whole table than to patch it
+            self.build_transitions()
+        else:
+            for node in changed:
+                self.update_transitions(node)
 
     # Check if a node is in bounds, i.e. on the network
     def in_bounds(self, node):
@@ -135,14 +383,25 @@ class NetworkMdp:
         if self.node(origin) == INACTIVE:
             return TIMEOUT
 
+        # Follow the policy through flat views of the tables
+        nodes = self.nodes.ravel()
+        policies = self.policies.ravel()
+        transitions = self.transitions.reshape(-1, self.action_count)
+
         hops = 0
-        current_node = origin
-        while self.node(current_node) != DESTINATION:
-            action = actions[self.policy(current_node)]
-            current_node, reward = self.next_node(current_node, action)
+        current_node = origin[0] * self.nodes.shape[1] + origin[1]
+        while nodes[current_node] != DESTINATION:
+            current_node = transitions[current_node, policies[current_node]]
             hops = hops + 1
 
             if hops > max_hops:
                 return TIMEOUT
 
         return hops
+
+
+# Network for the map file (see NetworkMdp), or the given network itself if it already is one (e.g. a GraphNetworkMdp)
+def make_network(map_file, topology, precision=FULL):
+    if isinstance(map_file, NetworkMdp):
+        return map_file
+    return NetworkMdp(map_file, topology, precision)
@@ -0,0 +1,248 @@
+import NetworkMdp
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+
+
+# Split a rows x cols grid into a tile_rows x tile_cols grid of tiles, as [first row, last row + 1, first col,
+# last col + 1] of every tile
+def split_tiles(shape, tile_rows, tile_cols):
+    row_bounds = np.unique(np.linspace(0, shape[0], min(tile_rows, shape[0]) + 1).round().astype(np.int64))
+    col_bounds = np.unique(np.linspace(0, shape[1], min(tile_cols, shape[1]) + 1).round().astype(np.int64))
+    return [[int(row_bounds[i]), int(row_bounds[i + 1]), int(col_bounds[j]), int(col_bounds[j + 1])]
+            for i in range(len(row_bounds) - 1) for j in range(len(col_bounds) - 1)]
+
+
+# Split the nodes of a graph into (at most) the given number of contiguous ranges, as [first node, last node + 1] of
+# every range
+def split_ranges(size, parts):
+    bounds = np.unique(np.linspace(0, size, min(parts, size) + 1).round().astype(np.int64))
+    return [[int(bounds[i]), int(bounds[i + 1])] for i in range(len(bounds) - 1)]
+
+
+# Tile grid with one tile per worker, as close to square as the worker count allows
+def default_tiles(workers):
+    tile_rows = int(np.sqrt(workers))
+    while workers % tile_rows != 0:
+        tile_rows = tile_rows - 1
+    return [tile_rows, workers // tile_rows]
+
+
+class SharedArrays:
+    # NumPy arrays in shared memory blocks, which worker processes attach to by name
+    def __init__(self):
+        self.blocks = {}
+        self.specs = {}
+
+    def add(self, name, array):
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, array.dtype, buffer=block.buf)
+        shared[...] = array
+        self.blocks[name] = block
+        self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    # Copy of a shared array
+    def read(self, name):
+        block_name, shape, dtype = self.specs[name]
+        return np.ndarray(shape, np.dtype(dtype), buffer=self.blocks[name].buf).copy()
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+
+# Attach to the shared arrays described by specs, returning the blocks (to keep them open) and the arrays
+def attach(specs):
+    blocks = {}
+    arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        blocks[name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=blocks[name].buf)
+    return blocks, arrays
+
+
+class Tile:
+    # Part of the grid swept by one worker. The constant parts of the backup are kept per tile: the reward of every
+    # action, whether it stays in place, and which nodes are active
+    def __init__(self, bounds, arrays, torus):
+        self.row_start, self.row_end, self.col_start, self.col_end = bounds
+        self.region = np.s_[self.row_start:self.row_end, self.col_start:self.col_end]
+        shape = arrays["nodes"].shape
+        rows = np.arange(self.row_start, self.row_end)
+        cols = np.arange(self.col_start, self.col_end)
+
+        # Rows and cols of the tile and its one node wide halo. Off the edge of a mesh the halo is never used, since
+        # the actions that would leave the network stay in place, so it's clipped there instead of wrapped around
+        halo_rows = np.arange(self.row_start - 1, self.row_end + 1)
+        halo_cols = np.arange(self.col_start - 1, self.col_end + 1)
+        if torus:
+            self.halo = np.ix_(halo_rows % shape[0], halo_cols % shape[1])
+        else:
+            self.halo = np.ix_(np.clip(halo_rows, 0, shape[0] - 1), np.clip(halo_cols, 0, shape[1] - 1))
+
+        transitions = arrays["transitions"][self.row_start:self.row_end, self.col_start:self.col_end]
+        own = rows[:, np.newaxis] * shape[1] + cols
+        self.stays = np.moveaxis(transitions == own[..., np.newaxis], -1, 0)
+        self.rewards = np.moveaxis(arrays["rewards"][self.row_start:self.row_end, self.col_start:self.col_end], -1, 0)
+        self.active = arrays["nodes"][self.row_start:self.row_end, self.col_start:self.col_end] != NetworkMdp.INACTIVE
+
+    # Value of taking each action from every node of the tile, shape (actions, rows, cols)
+    def action_values(self, values, discount):
+        padded = values[self.halo]
+        height = self.row_end - self.row_start
+        width = self.col_end - self.col_start
+        own = padded[1:-1, 1:-1]
+
+        next_values = np.stack([padded[1 + row:1 + row + height, 1 + col:1 + col + width]
+                                for row, col in NetworkMdp.action_offsets])
+        return self.rewards + discount * np.where(self.stays, own, next_values)
+
+    # Largest of the action values of every node of the tile
+    def best_values(self, q):
+        return np.max(q, axis=0)
+
+    # Action that maximizes the action values of every node of the tile, randomly picking between actions with the
+    # same value
+    def best_actions(self, q, rng):
+        keys = rng.random(q.shape)
+        keys[q != np.max(q, axis=0)] = -1
+        return np.argmax(keys, axis=0)
+
+    # Back up every node of the tile from values into new_values, returning the largest change
+    def sweep(self, values, new_values, discount):
+        own = values[self.region]
+        updated = np.where(self.active, self.best_values(self.action_values(values, discount)), own)
+        new_values[self.region] = updated
+        return np.max(np.abs(updated - own), initial=0)
+
+    # Set the policy of every active node of the tile to an action that maximizes the value function, randomly picking
+    # between actions with the same value
+    def greedy_policy(self, values, policies, discount, rng):
+        best_a = self.best_actions(self.action_values(values, discount), rng)
+
+        tile_policies = policies[self.region]
+        tile_policies[self.active] = best_a[self.active]
+
+
+class NodeRange(Tile):
+    # Contiguous range of the nodes of a graph network (nodes of shape (N, 1)) swept by one worker. Any node can link to
+    # any other, so the backup reads the whole value table through the transitions instead of a halo. The range's
+    # entries of the per-link tables are contiguous too, see GraphNetworkMdp
+    def __init__(self, bounds, arrays):
+        self.start, self.end = bounds
+        self.region = np.s_[self.start:self.end]
+
+        link_starts = arrays["link_starts"][self.start:self.end + 1]
+        self.transitions = arrays["transitions"][link_starts[0]:link_starts[-1]]
+        self.rewards = arrays["rewards"][link_starts[0]:link_starts[-1]]
+        self.degrees = np.diff(link_starts)
+        self.active = arrays["nodes"][self.region] != NetworkMdp.INACTIVE
+
+    # Value of taking each action from every node of the range, one entry per link
+    def action_values(self, values, discount):
+        return self.rewards + discount * values.ravel()[self.transitions]
+
+    def best_values(self, q):
+        return NetworkMdp.segment_best(q, self.degrees)[:, np.newaxis]
+
+    def best_actions(self, q, rng):
+        keys = rng.random(q.shape)
+        keys[q != np.repeat(NetworkMdp.segment_best(q, self.degrees), self.degrees)] = -1
+        return NetworkMdp.segment_argbest(keys, self.degrees)[:, np.newaxis]
+
+
+# Sweep the given tiles until the largest change over all workers is below theta. Every sweep reads the values of the
+# previous one from one buffer and writes the other, and the workers wait for each other between sweeps, so every node
+# is updated from the previous sweep's values like vectorized_value_iteration does
+def sweep_tiles(worker, tile_bounds, arrays, discount, theta, topology, barrier, seed):
+    if topology == NetworkMdp.GRAPH:
+        tiles = [NodeRange(bounds, arrays) for bounds in tile_bounds]
+    else:
+        tiles = [Tile(bounds, arrays, topology == NetworkMdp.TORUS) for bounds in tile_bounds]
+    buffers = [arrays["values"], arrays["next_values"]]
+    changes = arrays["changes"]
+
+    sweep = 0
+    nabla = theta
+    while nabla >= theta:
+        values = buffers[sweep % 2]
+        new_values = buffers[(sweep + 1) % 2]
+
+        # Changes of alternate sweeps go to alternate rows, so a worker that's ahead doesn't overwrite a change another
+        # worker is still reading
+        changes[sweep % 2, worker] = max([tile.sweep(values, new_values, discount) for tile in tiles], default=0)
+        barrier.wait()
+
+        nabla = np.max(changes[sweep % 2])
+        if worker == 0:
+            print(nabla)
+        sweep = sweep + 1
+
+    # Leave the final values in the first buffer, and pick the policies from them
+    values = buffers[sweep % 2]
+    rng = np.random.default_rng(seed)
+    for tile in tiles:
+        if sweep % 2 == 1:
+            buffers[0][tile.region] = values[tile.region]
+        tile.greedy_policy(values, arrays["policies"], discount, rng)
+
+
+# Worker process: attach to the shared arrays and sweep the worker's tiles
+def run_worker(worker, tile_bounds, specs, discount, theta, topology, barrier, seed):
+    blocks, arrays = attach(specs)
+    try:
+        sweep_tiles(worker, tile_bounds, arrays, discount, theta, topology, barrier, seed)
+    except BaseException:
+        # Don't leave the other workers waiting for this one
+        barrier.abort()
+        raise
+
+    del arrays
+    for block in blocks.values():
+        block.close()
+
+
+# Value iteration for a grid network with the grid split into a tiles[0] x tiles[1] grid of tiles, swept by a pool of
+# worker processes sharing the values and policies. Tiles are dealt out to the workers in turn. A graph network is split
+# into tiles[0] * tiles[1] contiguous ranges of nodes instead
+def value_iteration(network, discount, theta, workers, tiles=None, seed=None):
+    if tiles is None:
+        tiles = default_tiles(workers)
+
+    if network.topology == NetworkMdp.GRAPH:
+        tile_bounds = split_ranges(network.nodes.shape[0], tiles[0] * tiles[1])
+    else:
+        tile_bounds = split_tiles(network.nodes.shape, tiles[0], tiles[1])
+    workers = min(workers, len(tile_bounds))
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+
+    shared = SharedArrays()
+    try:
+        shared.add("nodes", network.nodes)
+        shared.add("transitions", network.transitions)
+        shared.add("rewards", network.rewards)
+        shared.add("link_starts", network.link_starts)
+        shared.add("values", network.values)
+        shared.add("next_values", network.values)
+        shared.add("policies", network.policies)
+        shared.add("changes", np.zeros((2, workers)))
+
+        barrier = multiprocessing.Barrier(workers)
+        processes = [multiprocessing.Process(target=run_worker,
+                                             args=(worker, tile_bounds[worker::workers], shared.specs, discount, theta,
+                                                   network.topology, barrier, seeds[worker]))
+                     for worker in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        if any(process.exitcode != 0 for process in processes):
+            raise RuntimeError("A value iteration worker failed")
+
+        network.values[...] = shared.read("values")
+        network.policies[...] = shared.read("policies")
+    finally:
+        shared.close()
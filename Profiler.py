@@ -0,0 +1,109 @@
+import TrafficMetrics
+import time
+import numpy as np
+
+# Methods timed as phases when a profiler is attached, on the solver and on its network. Phases a solver doesn't have
+# are skipped. The time spent in send_packet outside of the other phases is the Q/value update and loop overhead
+SOLVER_PHASES = ["send_packet", "get_action", "best_q", "backward_update", "replan"]
+NETWORK_PHASES = ["transition", "next_node", "send_packet"]
+
+
+class Profiler:
+    def __init__(self, sample_every=1000):
+        # Call count, total time and time not spent in other phases (self time) of every phase
+        self.calls = {}
+        self.seconds = {}
+        self.self_seconds = {}
+
+        # Packet counters, from the solver's send_packet
+        self.packets = 0
+        self.hops = 0
+        self.timeouts = 0
+
+        # Counters and cumulative self time of every phase, recorded every sample_every packets
+        self.sample_every = sample_every
+        self.samples = []
+
+        self.attached = []
+        self.start_time = None
+
+        # Time spent in the phases called by each phase currently running, innermost last
+        self.child_seconds = [0.0]
+
+    # Time the solver's (and its network's) phases until detach is called. Timing works by shadowing the methods with
+    # timed versions on the instances, so solvers without a profiler attached don't pay anything for it
+    def attach(self, solver):
+        for name in SOLVER_PHASES:
+            if hasattr(solver, name):
+                self.wrap(solver, name, name, count_packets=name == "send_packet")
+        for name in NETWORK_PHASES:
+            self.wrap(solver.network, name, "network." + name)
+
+        self.start_time = time.perf_counter()
+
+    def detach(self):
+        for owner, name in self.attached:
+            delattr(owner, name)
+        self.attached = []
+
+    def wrap(self, owner, name, phase, count_packets=False):
+        function = getattr(owner, name)
+        self.calls.setdefault(phase, 0)
+        self.seconds.setdefault(phase, 0.0)
+        self.self_seconds.setdefault(phase, 0.0)
+
+        def timed(*args, **kwargs):
+            self.child_seconds.append(0.0)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            children = self.child_seconds.pop()
+            self.child_seconds[-1] += elapsed
+
+            self.calls[phase] += 1
+            self.seconds[phase] += elapsed
+            self.self_seconds[phase] += elapsed - children
+
+            if count_packets:
+                self.record_packet(result)
+            return result
+
+        setattr(owner, name, timed)
+        self.attached.append((owner, name))
+
+    # Count a packet, with the same definition of a timeout as TrafficMetrics
+    def record_packet(self, hops):
+        self.packets = self.packets + 1
+        if TrafficMetrics.timed_out(hops):
+            self.timeouts = self.timeouts + 1
+        else:
+            self.hops = self.hops + hops
+
+        if self.packets % self.sample_every == 0:
+            self.samples.append([self.packets, self.hops, self.timeouts, time.perf_counter() - self.start_time] +
+                                [self.self_seconds[phase] for phase in self.self_seconds])
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        return {
+            "seconds": elapsed,
+            "packets": self.packets,
+            "hops": self.hops,
+            "timeouts": self.timeouts,
+            "phases": {phase: {"calls": self.calls[phase], "seconds": self.seconds[phase],
+                               "self_seconds": self.self_seconds[phase]} for phase in self.calls}
+        }
+
+    # Samples as arrays: packets, hops, timeouts, seconds, and the cumulative self time of every phase
+    def series(self):
+        columns = ["packets", "hops", "timeouts", "seconds"] + list(self.self_seconds.keys())
+        samples = np.array(self.samples).reshape(-1, len(columns))
+        return {column: samples[:, k] for k, column in enumerate(columns)}
+
+    def report(self):
+        summary = self.summary()
+        print(f"{summary['packets']} packets, {summary['hops']} hops, {summary['timeouts']} timeouts in "
+              f"{summary['seconds']:.3f} s")
+        for phase, stats in sorted(summary["phases"].items(), key=lambda item: -item[1]["self_seconds"]):
+            if stats["calls"] > 0:
+                print(f"  {phase}: {stats['calls']} calls, {stats['self_seconds']:.3f} s self, {stats['seconds']:.3f} s total")
@@ -0,0 +1,111 @@
+import numpy as np
+
+# What is kept of a learner's Q table history
+FULL = 0        # Every change, so Q can be rebuilt after any step
+SAMPLED = 1     # The changes since the last sample every k steps, so Q can be rebuilt after every k-th step
+RING = 2        # The changes of the last N steps, so Q can be rebuilt after any of them
+
+# Records allocated at first, doubled whenever they fill up (FULL and SAMPLED)
+INITIAL_CAPACITY = 1024
+
+
+class QHistory:
+    # Log of the changes to a Q table indexed by [state, action], stored as parallel arrays of the step, state, action,
+    # reward and new Q value of every change instead of a copy of the table per step. By default only the last capacity
+    # changes are kept (RING), since a FULL or SAMPLED log grows for as long as the learner runs
+    def __init__(self, q, mode=RING, every=1, capacity=1000):
+        self.mode = mode
+        self.every = every
+
+        # Q before the first change still in the log. Changes that drop out of a ring buffer are folded into it
+        self.base = np.copy(q)
+
+        self.capacity = capacity if mode == RING else INITIAL_CAPACITY
+        self.steps = np.zeros(self.capacity, np.int64)
+        self.states = np.zeros(self.capacity, np.int64)
+        self.actions = np.zeros(self.capacity, np.int64)
+        self.rewards = np.zeros(self.capacity)
+        self.values = np.zeros(self.capacity, q.dtype)
+
+        # Number of records in the log, and where the oldest one is (only moves once a ring buffer is full)
+        self.size = 0
+        self.start = 0
+
+        # Steps recorded so far, and the changes since the last sample keyed by (state, action) when sampling
+        self.step_count = 0
+        self.pending = {}
+
+    # Record a step that took the action in the state, got the reward and set Q[state, action] to value
+    def record(self, state, action, reward, value):
+        step = self.step_count
+        self.step_count = self.step_count + 1
+
+        if self.mode != SAMPLED:
+            self.append(step, state, action, reward, value)
+            return
+
+        # Only keep the last change to every entry until the next sample
+        self.pending[(state, action)] = (reward, value)
+        if self.step_count % self.every == 0:
+            self.flush()
+
+    # Log the changes waiting for the next sample as a sample of the last step recorded, so Q can be rebuilt after it
+    # (at the end of an episode, say). Nothing is waiting unless sampling
+    def flush(self):
+        for (pending_state, pending_action), (pending_reward, pending_value) in self.pending.items():
+            self.append(self.step_count - 1, pending_state, pending_action, pending_reward, pending_value)
+        self.pending.clear()
+
+    def append(self, step, state, action, reward, value):
+        if self.size == self.capacity:
+            if self.mode == RING:
+                # Fold the oldest change into the base table and reuse its slot
+                self.base[self.states[self.start], self.actions[self.start]] = self.values[self.start]
+                self.start = (self.start + 1) % self.capacity
+                self.size = self.size - 1
+            else:
+                self.grow()
+
+        index = (self.start + self.size) % self.capacity
+        self.steps[index] = step
+        self.states[index] = state
+        self.actions[index] = action
+        self.rewards[index] = reward
+        self.values[index] = value
+        self.size = self.size + 1
+
+    def grow(self):
+        self.capacity = 2 * self.capacity
+        for name in ["steps", "states", "actions", "rewards", "values"]:
+            array = getattr(self, name)
+            grown = np.zeros(self.capacity, array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    # Records in the log from oldest to newest, as a dict of arrays. Changes waiting for the next sample are logged first
+    def records(self):
+        self.flush()
+        order = (self.start + np.arange(self.size)) % self.capacity
+        return {"steps": self.steps[order], "states": self.states[order], "actions": self.actions[order],
+                "rewards": self.rewards[order], "values": self.values[order]}
+
+    # Steps Q can be rebuilt after
+    def recorded_steps(self):
+        return np.unique(self.records()["steps"])
+
+    # Rebuild the Q table as it was right after the given step (counting from 0)
+    def q_at(self, step):
+        records = self.records()
+        if step not in records["steps"]:
+            raise ValueError(f"Q after step {step} isn't in the history")
+
+        # Apply the last change to every entry up to the step
+        done = records["steps"] <= step
+        states = records["states"][done][::-1]
+        actions = records["actions"][done][::-1]
+        values = records["values"][done][::-1]
+        _, last = np.unique(states * self.base.shape[1] + actions, return_index=True)
+
+        q = np.copy(self.base)
+        q[states[last], actions[last]] = values[last]
+        return q
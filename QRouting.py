@@ -1,43 +1,164 @@
 import NetworkMdp
+import ActionSelector
 import TrafficGenerator
 import numpy as np
-import random
+import os
+import tempfile
+from collections import OrderedDict
+
+# Memory the per-destination Q (and confidence) tables may take by default, see QRouting.max_destinations
+DESTINATION_TABLE_BYTES = 256 * 2 ** 20
+
+# Per-destination tables are always stored compactly, whatever the precision of the map destination's tables
+DESTINATION_DTYPE = np.float32
+
+# Visits from which backward_update applies a path with array operations instead of one visit at a time. Below it the
+# fixed cost of the array operations is more than the loop takes
+VECTORIZED_BACKWARD_VISITS = 64
+
+
+# Rank of every key among the earlier occurrences of the same key (0 for the first one). Entries with the same rank
+# have distinct keys, so they can be applied together with fancy indexing without any writes conflicting
+def occurrence_ranks(keys):
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+    counts = np.diff(np.append(starts, keys.size))
+
+    ranks = np.empty(keys.size, np.int64)
+    ranks[order] = np.arange(keys.size) - np.repeat(starts, counts)
+    return ranks
 
 
 class QRouting:
-    def __init__(self, mapfile, topology, epsilon=0.05, alpha=0.9, confidence_based=False, clambda=0.9):
-        self.network = NetworkMdp.NetworkMdp(mapfile, topology)
+    def __init__(self, mapfile, topology, epsilon=0.05, alpha=0.9, confidence_based=False, clambda=0.9,
+                 precision=NetworkMdp.FULL, max_destinations=None, spill_directory=None, seed=None):
+        self.network = NetworkMdp.make_network(mapfile, topology, precision)
+        dtype = NetworkMdp.value_dtypes[precision]
 
         # The Q function in this case represents the estimate for the time it takes to route from
         # one node to the destination by taking action a
-        self.q = 10000 * np.ones((self.network.nodes.shape[0], self.network.nodes.shape[1], len(NetworkMdp.actions)))
-       
+        self.q = self.network.new_table(10000, dtype)
+
         self.epsilon = epsilon
+        self.selector = ActionSelector.ActionSelector(seed)
         self.alpha = alpha
         self.confidence_based = confidence_based
         self.clambda = clambda
         if self.confidence_based:
-            self.c = 0.0001 * np.ones((self.network.nodes.shape[0], self.network.nodes.shape[1], len(NetworkMdp.actions)))
+            self.c = self.network.new_table(0.0001, dtype)
+
+        # Q (and confidence) tables for packets sent to other destinations than the one in the map, indexed by the flat
+        # destination node. Tables are allocated the first time a destination is used. Once there are more than
+        # max_destinations in memory (by default as many as fit in DESTINATION_TABLE_BYTES), the least recently used
+        # one is written to spill_directory (a temporary directory by default) and read back when it's used again, so
+        # nothing that was learned is lost
+        self.destination_tables = OrderedDict()
+        if max_destinations is None:
+            table_bytes = self.q.size * np.dtype(DESTINATION_DTYPE).itemsize * (2 if self.confidence_based else 1)
+            max_destinations = max(1, DESTINATION_TABLE_BYTES // table_bytes)
+        self.max_destinations = max_destinations
+        self.spill_directory = spill_directory
+        self.temporary_directory = None
+        self.spilled_destinations = set()
+        self.evicted_destinations = 0
+
+        # Flat node and action taken at every hop of the packet being sent, for the backward pass. The buffers are
+        # reused between packets and grown when a packet may take more hops
+        self.path_nodes = np.zeros(101, np.int64)
+        self.path_actions = np.zeros(101, np.int64)
 
-    def send_packet(self, origin, max_hops=100):
-        current_node = origin
-        action = self.get_action(current_node)
+    # None for the map's destination, which uses the main tables, otherwise the destination node itself
+    def normalize_destination(self, destination):
+        if destination is None or self.network.node(destination) == NetworkMdp.DESTINATION:
+            return None
+        return destination
+
+    # Q and confidence tables (None if not confidence based) for routing to the destination node, or to the map's
+    # destination if it's None
+    def tables(self, destination=None):
+        destination = self.normalize_destination(destination)
+        if destination is None:
+            return self.q, self.c if self.confidence_based else None
+
+        key = destination[0] * self.network.nodes.shape[1] + destination[1]
+        tables = self.destination_tables.get(key)
+        if tables is not None:
+            self.destination_tables.move_to_end(key)
+            return tables
+
+        if key in self.spilled_destinations:
+            tables = self.read_spilled(key)
+        else:
+            tables = (self.network.new_table(10000, DESTINATION_DTYPE),
+                      self.network.new_table(0.0001, DESTINATION_DTYPE) if self.confidence_based else None)
+        self.destination_tables[key] = tables
+
+        if len(self.destination_tables) > self.max_destinations:
+            self.spill(*self.destination_tables.popitem(last=False))
+        return tables
+
+    # Path of a spilled table of the (flat) destination
+    def spill_path(self, key, name):
+        return os.path.join(self.spill_directory, f"destination_{key}_{name}.npy")
+
+    # Write the tables of the (flat) destination out of memory
+    def spill(self, key, tables):
+        if self.spill_directory is None:
+            # Removed along with the solver
+            self.temporary_directory = tempfile.TemporaryDirectory(prefix="qrouting_")
+            self.spill_directory = self.temporary_directory.name
+        os.makedirs(self.spill_directory, exist_ok=True)
+
+        for name, table in zip(["q", "c"], tables):
+            if table is not None:
+                np.save(self.spill_path(key, name), table)
+        self.spilled_destinations.add(key)
+        self.evicted_destinations = self.evicted_destinations + 1
+
+    # Read the spilled tables of the (flat) destination back into memory
+    def read_spilled(self, key):
+        tables = []
+        for name in ["q", "c"]:
+            path = self.spill_path(key, name)
+            if os.path.exists(path):
+                tables.append(np.load(path))
+                os.remove(path)
+            else:
+                tables.append(None)
+        self.spilled_destinations.remove(key)
+        return tuple(tables)
+
+    # Send a packet to the destination node, or to the map's destination if it's None
+    def send_packet(self, origin, max_hops=100, destination=None):
+        destination = self.normalize_destination(destination)
+        q, c = self.tables(destination)
+        current_node = tuple(origin)
+        action = self.get_action(current_node, q, c)
+
+        if len(self.path_nodes) < max_hops + 1:
+            self.path_nodes = np.zeros(max_hops + 1, np.int64)
+            self.path_actions = np.zeros(max_hops + 1, np.int64)
+        width = self.network.nodes.shape[1]
 
         hops = 0
-        nodes = []
-        while self.network.node(current_node) != NetworkMdp.DESTINATION:
-            next_node, reward = self.network.next_node(current_node, NetworkMdp.actions[action])
-            next_action = self.get_action(next_node)
+        while not self.delivered(current_node, destination):
+            next_node, reward = self.network.transition(current_node, action)
+            next_action = self.get_action(next_node, q, c)
 
-            q_current = self.q[current_node[0]][current_node[1]][action]
-            q_next = self.best_q(next_node)
+            link = self.network.link(current_node, action)
+            q_current = q[link]
+            q_next = self.best_q(next_node, q)
 
             new_q = q_current + self.alpha * (q_next - q_current)
 
-            self.q[current_node[0]][current_node[1]][action] = new_q
-            self.network.set_policy(current_node, action)
+            q[link] = new_q
+            if destination is None:
+                # The network's policies only route to the map's destination
+                self.network.set_policy(current_node, action)
 
-            nodes.append((current_node, action))
+            self.path_nodes[hops] = current_node[0] * width + current_node[1]
+            self.path_actions[hops] = action
             current_node = next_node
             action = next_action
 
@@ -46,71 +167,251 @@ class QRouting:
             if hops > max_hops:
                 break
 
-        time = hops
-        for node, action in nodes:
-            old_estimate = self.q[node[0]][node[1]][action]
-            
-            self.q[node[0]][node[1]][action] = time
-            
-            if self.confidence_based:
-                # update confidence levels
-                if (time > old_estimate):
-                    # decrease confidence, limited to 0.0
-                    self.c[node[0]][node[1]][action] *= 0.9
-                if (time <= old_estimate):
-                    # increase confidence, limited to 1.0
-                    self.c[node[0]][node[1]][action] *= 1.1
-                    if self.c[node[0]][node[1]][action] > 1:
-                        self.c[node[0]][node[1]][action] = 1.0
-                for a in NetworkMdp.actions.keys():
-                    self.c[node[0]][node[1]][a] *= self.clambda # discount factor
-            time = time - 1
+        self.backward_update(self.path_nodes[:hops], self.path_actions[:hops], hops - np.arange(hops), q, c)
 
         return hops
 
-    def get_action(self, node):
-        if random.uniform(0, 1) <= self.epsilon:
-            # Randomly return an action
-            return random.randint(0, len(NetworkMdp.actions) - 1)
+    # Route a batch of packets from the given origins (an array of [row, col]) together, advancing every packet still in
+    # flight by one hop per step. Each step reads Q once and then applies the updates of all packets as if they were
+    # made one after another in packet order. Every packet goes to the destination node, or to the map's destination if
+    # it's None. Returns the number of hops of every packet
+    def send_packets(self, origins, max_hops=100, destination=None):
+        destination = self.normalize_destination(destination)
+        tables = self.tables(destination)
+        origins = np.asarray(origins)
+        transitions = self.network.transitions.reshape(-1)
+        q = tables[0].reshape(-1)
 
-        best_q = float('inf')
-        best_actions = []
-        for action in NetworkMdp.actions.keys():
+        # Whether every node is where the packets are going
+        if destination is None:
+            arrived = self.network.nodes.ravel() == NetworkMdp.DESTINATION
+        else:
+            arrived = np.zeros(self.network.nodes.size, bool)
+            arrived[destination[0] * self.network.nodes.shape[1] + destination[1]] = True
+
+        current_nodes = origins[:, 0] * self.network.nodes.shape[1] + origins[:, 1]
+        current_actions = self.get_actions(current_nodes, *tables)
+        hops = np.zeros(len(origins), np.int64)
+
+        # Flat node and action taken at every hop of every packet, for the backward pass
+        path_nodes = np.zeros((len(origins), max_hops + 1), np.int64)
+        path_actions = np.zeros((len(origins), max_hops + 1), np.int64)
+
+        in_flight = np.flatnonzero(~arrived[current_nodes])
+        while in_flight.size > 0:
+            current_node = current_nodes[in_flight]
+            action = current_actions[in_flight]
+            next_node = transitions[self.network.flat_links(current_node, action)]
+            next_action = self.get_actions(next_node, *tables)
+
+            links, counts = self.network.node_links(next_node)
+            min_q = NetworkMdp.segment_best(q[links], counts, minimize=True)
+            self.update_q(current_node, action, min_q, tables[0], destination is None)
+
+            path_nodes[in_flight, hops[in_flight]] = current_node
+            path_actions[in_flight, hops[in_flight]] = action
+            hops[in_flight] += 1
+            current_nodes[in_flight] = next_node
+            current_actions[in_flight] = next_action
+
+            done = arrived[next_node] | (hops[in_flight] > max_hops)
+            if np.any(done):
+                finished = in_flight[done]
+                self.backward_pass(path_nodes[finished], path_actions[finished], hops[finished], *tables)
+                in_flight = in_flight[~done]
+
+        return hops
+
+    # Move Q towards the targets for the given flat nodes and actions. When several packets update the same entry,
+    # the combined result is the same as applying the updates in order: after k updates towards t_0 ... t_k-1,
+    # q = (1 - alpha)^k q + sum_j alpha (1 - alpha)^(k - 1 - j) t_j. The Q table is the map destination's by default,
+    # and the network's policies are only set for it if set_policies is
+    def update_q(self, flat_nodes, actions, targets, q=None, set_policies=True):
+        q = (self.q if q is None else q).reshape(-1)
+        keys = self.network.flat_links(flat_nodes, actions)
+
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        counts = np.diff(np.append(starts, keys.size))
+        remaining = np.repeat(starts + counts - 1, counts) - np.arange(keys.size)
+
+        weighted = self.alpha * (1 - self.alpha) ** remaining * targets[order]
+        q[keys[starts]] = (1 - self.alpha) ** counts * q[keys[starts]] + np.add.reduceat(weighted, starts)
+
+        if not set_policies:
+            return
+
+        # The last packet through a node sets its policy
+        last = occurrence_ranks(flat_nodes[::-1])[::-1] == 0
+        self.network.policies.ravel()[flat_nodes[last]] = actions[last]
+
+    # Overwrite Q along the paths of finished packets with the number of hops that were left, in the same order as
+    # send_packet would (packet by packet, from the start of each path), in the given tables (the map destination's by
+    # default)
+    def backward_pass(self, path_nodes, path_actions, hops, q=None, c=None):
+        if q is None:
+            q, c = self.tables()
+        valid = np.arange(path_nodes.shape[1]) < hops[:, np.newaxis]
+        times = (hops[:, np.newaxis] - np.arange(path_nodes.shape[1]))[valid]
+        self.backward_update(path_nodes[valid], path_actions[valid], times, q, c)
+
+    # Overwrite Q for the given flat nodes and actions, in order, with the number of hops that were left from each of
+    # them (times), updating the confidence in the old estimates. The result is the same as making the updates one
+    # visit at a time
+    def backward_update(self, flat_nodes, actions, times, q, c):
+        if flat_nodes.size < VECTORIZED_BACKWARD_VISITS:
+            self.backward_loop(flat_nodes.tolist(), actions.tolist(), times.tolist(), q, c)
+        else:
+            self.backward_arrays(flat_nodes, actions, times, q, c)
+
+    # backward_update with array operations, for long paths (or many paths at once)
+    def backward_arrays(self, flat_nodes, actions, times, q, c):
+        q = q.reshape(-1)
+        keys = self.network.flat_links(flat_nodes, actions)
+
+        # Visits to every (node, action) entry, in order. Only the last write to an entry is left in Q
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        times = times[order]
+        first = np.concatenate([[True], keys[1:] != keys[:-1]])
+        last = np.append(first[1:], True)
+
+        if self.confidence_based:
+            self.update_confidence(flat_nodes, order, keys, times, first, q, c)
+
+        q[keys[last]] = times[last]
+
+    # backward_update one visit at a time, for short paths. The confidence rows of the visited nodes are updated as
+    # Python lists and written back at the end
+    def backward_loop(self, flat_nodes, actions, times, q, c):
+        q = q.reshape(-1)
+        if self.confidence_based:
+            c = c.reshape(-1)
+        link_starts = self.network.link_starts
+        rows = {}
+
+        for node, action, time in zip(flat_nodes, actions, times):
+            start = int(link_starts[node])
+            key = start + action
             if self.confidence_based:
-                q = self.q[node[0]][node[1]][action]*(2-self.c[node[0]][node[1]][action])
-            else:
-                q = self.q[node[0]][node[1]][action]
-
-            if q < best_q:
-                best_q = q
-                best_actions.clear()
-                best_actions.append(action)
-            elif q == best_q:
-                best_actions.append(action)
-
-        if len(best_actions) == 0:
-            # No actions found that maximize the Q function, randomly pick one
-            return np.random.randint(0, len(NetworkMdp.actions) - 1)
+                row = rows.get(start)
+                if row is None:
+                    row = rows[start] = c[start:link_starts[node + 1]].tolist()
+                if time > q[key]:
+                    # Decrease confidence
+                    row[action] = row[action] * 0.9
+                else:
+                    # Increase confidence, limited to 1.0
+                    row[action] = min(row[action] * 1.1, 1.0)
+                row[:] = [confidence * self.clambda for confidence in row]
+            q[key] = time
+
+        for start, row in rows.items():
+            c[start:start + len(row)] = row
+
+    # Confidence updates of backward_update, given its visits sorted by entry. Each visit scales the confidence in its
+    # entry by 0.9 if the estimate it overwrites was too low, or by 1.1 limited to 1.0 otherwise, then discounts the
+    # confidence in every action of the node by clambda. Chaining x -> a * x and x -> min(a * x, 1.0) gives
+    # min(A * x, B), where A is the product of all the factors and B the smallest product of the factors after a limit.
+    # The products are taken as sums of logs, since thousands of visits to one entry overflow A and underflow B
+    def update_confidence(self, flat_nodes, order, keys, times, first, q, c):
+        entries = c.reshape(-1)
+        size = keys.size
+
+        # Number of visits to the node from every visit on (counting itself), and in all
+        node_order = np.argsort(flat_nodes, kind="stable")
+        sorted_nodes = flat_nodes[node_order]
+        starts = np.flatnonzero(np.diff(sorted_nodes, prepend=-1))
+        counts = np.diff(starts, append=size)
+        remaining = np.empty(size, np.int64)
+        remaining[node_order] = np.repeat(starts + counts, counts) - np.arange(size)
+        node_visits = np.empty(size, np.int64)
+        node_visits[node_order] = np.repeat(counts, counts)
+
+        # A visit overwrites the estimate in the table if it's the first to its entry, or the previous visit's time
+        old_estimates = q[keys]
+        old_estimates[1:] = np.where(first[1:], old_estimates[1:], times[:-1])
+        increase = times <= old_estimates
+
+        # Increases and decreases after every visit to the same entry
+        entry_starts = np.flatnonzero(first)
+        entry_counts = np.diff(entry_starts, append=size)
+        increases = np.cumsum(increase[::-1])[::-1]
+        increases_after = increases - np.repeat(increases[entry_starts] - np.add.reduceat(increase, entry_starts),
+                                                entry_counts) - increase
+        visits_after = np.repeat(entry_starts + entry_counts - 1, entry_counts) - np.arange(size)
+
+        log_scales = np.log(0.9) * (visits_after - increases_after) + np.log(1.1) * increases_after
+        log_bounds = np.where(increase, np.log(self.clambda) * remaining[order] + log_scales, np.inf)
+        log_factors = log_scales[first] + np.where(increase[first], np.log(1.1), np.log(0.9))
+
+        # Scale the visited entries, including the discount of every visit to their node, then discount the other
+        # actions of the visited nodes once per visit
+        with np.errstate(divide="ignore"):
+            log_entries = np.log(entries[keys[first]].astype(np.float64))
+        log_entries = log_entries + np.log(self.clambda) * node_visits[order][first]
+        scaled = np.exp(np.minimum(log_factors + log_entries, np.minimum.reduceat(log_bounds, entry_starts)))
+        links, link_counts = self.network.node_links(sorted_nodes[starts])
+        entries[links] *= np.repeat(self.clambda ** counts, link_counts)
+        entries[keys[first]] = scaled
+
+    # Whether a packet at the node has arrived at the destination (the map's destination if it's None)
+    def delivered(self, node, destination=None):
+        if destination is None:
+            return self.network.node(node) == NetworkMdp.DESTINATION
+        return node[0] == destination[0] and node[1] == destination[1]
+
+    # Epsilon-greedy action for the node, using the given Q and confidence tables (the map destination's by default)
+    def get_action(self, node, q=None, c=None):
+        if q is None:
+            q, c = self.tables()
+
+        if self.confidence_based:
+            values = self.network.row(q, node) * (2 - self.network.row(c, node))
         else:
-            # Randomly pick an action from the best actions that maximized the Q function
-            return best_actions[np.random.randint(0, len(best_actions))]
+            values = self.network.row(q, node)
 
-    def best_q(self, node):
-        best_q = float('inf')
-        for action in NetworkMdp.actions.keys():
-            q = self.q[node[0]][node[1]][action]
+        # Pick the action with the lowest (confidence weighted) estimate, or explore with probability epsilon
+        return self.selector.select(values, self.epsilon, minimize=True)
+
+    # Vectorized get_action for an array of flat node indices
+    def get_actions(self, flat_nodes, q=None, c=None):
+        if q is None:
+            q, c = self.tables()
 
-            if q < best_q:
-                best_q = q
+        links, counts = self.network.node_links(flat_nodes)
+        q = q.reshape(-1)[links]
+        if self.confidence_based:
+            q = q * (2 - c.reshape(-1)[links])
+
+        return self.selector.select_batch(q, counts, self.epsilon, minimize=True)
+
+    # Set the network policy of every node to the action with the lowest (confidence weighted) Q estimate
+    def greedy_policy(self):
+        if self.confidence_based:
+            q = self.q * (2 - self.c)
+        else:
+            q = self.q
+        self.network.policies[...] = self.network.best_links(q, minimize=True)
+
+    def best_q(self, node, q=None):
+        if q is None:
+            q = self.q
+
+        best_q = float('inf')
+        for estimate in self.network.row(q, node):
+            if estimate < best_q:
+                best_q = estimate
 
         return best_q
 
 
-def main():
-    qroute = QRouting("mesh4x4.txt", NetworkMdp.TORUS, confidence_based=True)
+def main(mapfile="mesh4x4.txt", topology=NetworkMdp.TORUS, packet_count=10000, plot=True, confidence_based=True):
+    qroute = QRouting(mapfile, topology, confidence_based=confidence_based)
 
     traffic = TrafficGenerator.TrafficGenerator(qroute)
-    traffic.simulate(10000, "Confidence Q-Routing", False)
+    return traffic.simulate(packet_count, "Confidence Q-Routing" if confidence_based else "Q-Routing", False, plot=plot)
 
 
 if __name__ == '__main__':
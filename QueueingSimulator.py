@@ -0,0 +1,181 @@
+import NetworkMdp
+import TrafficMetrics
+import heapq
+import numpy as np
+from collections import deque
+
+# Types of events
+ARRIVAL = 0     # Packet arrives at a node (from outside the network or over a link)
+DEPARTURE = 1   # Packet finishes transmitting on a node's outgoing link
+
+LATENCY_PERCENTILES = [50, 90, 99, 99.9]
+
+
+class QueueingSimulator:
+    def __init__(self, solver, service_time=1.0, link_delay=0.0, seed=None, latency_points=100000):
+        # Any solver with a network and a get_action(node) method makes the forwarding decisions
+        self.solver = solver
+        self.network = solver.network
+
+        # Time to transmit a packet on a link, and time for it to reach the next node once transmitted
+        self.service_time = service_time
+        self.link_delay = link_delay
+        self.rng = np.random.default_rng(seed)
+
+        # Latencies kept for the percentiles, see TrafficMetrics.LatencyMetrics
+        self.latency_points = latency_points
+
+    # Simulate packets arriving as a Poisson process with the given rate (packets per unit time over the whole network)
+    # at uniformly random active nodes, until the given time. Alternatively, trace is an array of [time, row, col] rows
+    # of packet arrivals sorted by time, and packets arriving at inactive nodes are dropped. Each node forwards one
+    # packet at a time from a FIFO queue, packets that take more than max_hops hops are dropped. Returns a summary of
+    # the latencies, queue occupancy and throughput
+    def run(self, duration, rate=1.0, trace=None, max_hops=100):
+        nodes = self.network.nodes.ravel()
+        transitions = self.network.transitions.reshape(-1)
+        link_starts = self.network.link_starts
+        width = self.network.nodes.shape[1]
+
+        if trace is None:
+            sources = np.flatnonzero(nodes == NetworkMdp.ACTIVE)
+            arrivals = self.poisson_arrivals(sources, rate, duration)
+        else:
+            trace = np.asarray(trace)
+            trace = trace[trace[:, 0] < duration]
+            shape = self.network.nodes.shape
+            off_network = (trace[:, 1] < 0) | (trace[:, 1] >= shape[0]) | (trace[:, 2] < 0) | (trace[:, 2] >= shape[1])
+            if np.any(off_network):
+                origin = tuple(trace[np.argmax(off_network), 1:].astype(np.int64).tolist())
+                raise ValueError(f"Trace arrival at {origin} is off the network")
+            arrivals = iter(zip(trace[:, 0].tolist(), (trace[:, 1] * width + trace[:, 2]).astype(np.int64).tolist()))
+
+        # Start time and hops so far of every packet in flight, by packet number. Packets are removed once delivered or
+        # dropped
+        packets = {}
+        packet_count = 0
+
+        # FIFO of packets waiting for the outgoing link of the nodes that have any, and whether each link is busy
+        queues = {}
+        busy = np.zeros(nodes.size, bool)
+
+        # Time integral of the number of packets queued (including the one being transmitted) at each node
+        occupancy = np.zeros(nodes.size)
+        last_change = np.zeros(nodes.size)
+        max_queue = np.zeros(nodes.size, np.int64)
+
+        latencies = TrafficMetrics.LatencyMetrics(self.latency_points)
+        dropped = 0
+        events = []
+        sequence = 0
+
+        # Arrivals from outside the network are generated one at a time so the event queue only holds packets in flight
+        next_arrival = next(arrivals, None)
+        if next_arrival is not None:
+            heapq.heappush(events, (next_arrival[0], sequence, ARRIVAL, -1, next_arrival[1]))
+            sequence = sequence + 1
+
+        time = 0.0
+        while events:
+            time, _, event, packet, node = heapq.heappop(events)
+
+            if event == ARRIVAL:
+                if packet < 0:
+                    # New packet, and schedule the one after it
+                    packet = packet_count
+                    packet_count = packet_count + 1
+                    packets[packet] = [time, 0]
+
+                    next_arrival = next(arrivals, None)
+                    if next_arrival is not None:
+                        heapq.heappush(events, (next_arrival[0], sequence, ARRIVAL, -1, next_arrival[1]))
+                        sequence = sequence + 1
+
+                    if nodes[node] == NetworkMdp.INACTIVE:
+                        # Inactive nodes can't send packets
+                        del packets[packet]
+                        dropped = dropped + 1
+                        continue
+
+                if nodes[node] == NetworkMdp.DESTINATION:
+                    latencies.record(time - packets.pop(packet)[0])
+                    continue
+                if packets[packet][1] > max_hops:
+                    del packets[packet]
+                    dropped = dropped + 1
+                    continue
+
+                queued = len(queues[node]) if node in queues else 0
+                occupancy[node] += (queued + busy[node]) * (time - last_change[node])
+                last_change[node] = time
+                if busy[node]:
+                    queues.setdefault(node, deque()).append(packet)
+                    max_queue[node] = max(max_queue[node], queued + 2)
+                else:
+                    busy[node] = True
+                    max_queue[node] = max(max_queue[node], 1)
+                    heapq.heappush(events, (time + self.service_time, sequence, DEPARTURE, packet, node))
+                    sequence = sequence + 1
+
+            else:
+                # Forward the packet along the link chosen by the solver, then start on the next packet in the queue
+                action = self.solver.get_action(divmod(node, width))
+                packets[packet][1] += 1
+                next_node = int(transitions[link_starts[node] + action])
+                heapq.heappush(events, (time + self.link_delay, sequence, ARRIVAL, packet, next_node))
+                sequence = sequence + 1
+
+                queue = queues.get(node)
+                occupancy[node] += ((len(queue) if queue is not None else 0) + 1) * (time - last_change[node])
+                last_change[node] = time
+                if queue:
+                    heapq.heappush(events, (time + self.service_time, sequence, DEPARTURE, queue.popleft(), node))
+                    sequence = sequence + 1
+                    if not queue:
+                        del queues[node]
+                else:
+                    busy[node] = False
+
+        # Packets still queued at the end count towards occupancy until the last event
+        for node, queue in queues.items():
+            occupancy[node] += len(queue) * (time - last_change[node])
+        elapsed = max(time, np.finfo(float).tiny)
+
+        return {
+            "packets": packet_count,
+            "delivered": latencies.count,
+            "dropped": dropped,
+            "throughput": latencies.count / elapsed,
+            "latency_mean": latencies.mean if latencies.count else float("nan"),
+            "latency_percentiles": dict(zip(LATENCY_PERCENTILES, latencies.percentiles(LATENCY_PERCENTILES))),
+            "mean_queue": (occupancy / elapsed).reshape(self.network.nodes.shape),
+            "max_queue": max_queue.reshape(self.network.nodes.shape)
+        }
+
+    # Arrival times and (flat) origin nodes of a Poisson process over the sources, generated in blocks
+    def poisson_arrivals(self, sources, rate, duration, block_size=65536):
+        time = 0.0
+        while True:
+            times = time + np.cumsum(self.rng.exponential(1.0 / rate, block_size))
+            origins = sources[self.rng.integers(0, sources.size, block_size)]
+            for arrival_time, origin in zip(times.tolist(), origins.tolist()):
+                if arrival_time >= duration:
+                    return
+                yield arrival_time, origin
+            time = times[-1]
+
+
+def main():
+    import DynamicMethods
+
+    dp = DynamicMethods.DynamicMethods("mesh4x4.txt", NetworkMdp.TORUS, vectorized=True)
+    dp.value_iteration(0.9, 0.001)
+
+    for rate in [0.1, 0.5, 1.0, 2.0]:
+        summary = QueueingSimulator(dp, seed=0).run(10000, rate)
+        percentiles = ", ".join(f"p{p}: {latency:.1f}" for p, latency in summary["latency_percentiles"].items())
+        print(f"Rate {rate}: {summary['delivered']}/{summary['packets']} delivered, throughput {summary['throughput']:.3f}, "
+              f"latency {percentiles}, mean queue {np.mean(summary['mean_queue']):.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,16 @@
 import numpy as np
 import NetworkMdp
+import ActionSelector
 import TrafficGenerator
-import random
 
 
 class Sarsa:
-    def __init__(self, mapfile, topology, epsilon=0.05, alpha=0.9, gamma=0.9):
-        self.network = NetworkMdp.NetworkMdp(mapfile, topology)
-        self.q = np.zeros((self.network.nodes.shape[0], self.network.nodes.shape[1], len(NetworkMdp.actions)))
+    def __init__(self, mapfile, topology, epsilon=0.05, alpha=0.9, gamma=0.9, precision=NetworkMdp.FULL, seed=None):
+        self.network = NetworkMdp.make_network(mapfile, topology, precision)
+
+        self.q = self.network.new_table(0, NetworkMdp.value_dtypes[precision])
         self.epsilon = epsilon
+        self.selector = ActionSelector.ActionSelector(seed)
         self.alpha = alpha
         self.gamma = gamma
 
@@ -18,13 +20,14 @@ class Sarsa:
 
         hops = 0
         while self.network.node(current_node) != NetworkMdp.DESTINATION:
-            next_node, reward = self.network.next_node(current_node, NetworkMdp.actions[action])
+            next_node, reward = self.network.transition(current_node, action)
             next_action = self.get_action(next_node)
 
-            q_current = self.q[current_node[0]][current_node[1]][action]
-            q_next = self.q[next_node[0]][next_node[1]][next_action]
+            link = self.network.link(current_node, action)
+            q_current = self.q[link]
+            q_next = self.q[self.network.link(next_node, next_action)]
             new_q = q_current + self.alpha * (reward + self.gamma * q_next - q_current)
-            self.q[current_node[0]][current_node[1]][action] = new_q
+            self.q[link] = new_q
 
             self.network.set_policy(current_node, action)
 
@@ -39,35 +42,18 @@ class Sarsa:
         return hops
 
     def get_action(self, node):
-        if random.uniform(0, 1) <= self.epsilon:
-            # Randomly return an action
-            return random.randint(0, len(NetworkMdp.actions) - 1)
-
-        best_q = float('-inf')
-        best_actions = []
-        for action in NetworkMdp.actions.keys():
-            q = self.q[node[0]][node[1]][action]
-
-            if q > best_q:
-                best_q = q
-                best_actions.clear()
-                best_actions.append(action)
-            elif q == best_q:
-                best_actions.append(action)
+        return self.selector.select(self.network.row(self.q, node), self.epsilon)
 
-        if len(best_actions) == 0:
-            # No actions found that maximize the Q function, randomly pick one
-            return np.random.randint(0, len(NetworkMdp.actions) - 1)
-        else:
-            # Randomly pick an action from the best actions that maximized the Q function
-            return best_actions[np.random.randint(0, len(best_actions))]
+    # Set the network policy of every node to the action with the highest Q value
+    def greedy_policy(self):
+        self.network.policies[...] = self.network.best_links(self.q)
 
 
-def main():
-    sarsa = Sarsa("mesh4x4.txt", NetworkMdp.TORUS)
+def main(mapfile="mesh4x4.txt", topology=NetworkMdp.TORUS, packet_count=10000, plot=True):
+    sarsa = Sarsa(mapfile, topology)
 
     traffic = TrafficGenerator.TrafficGenerator(sarsa)
-    traffic.simulate(10000, "SARSA", False)
+    return traffic.simulate(packet_count, "SARSA", False, plot=plot)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,9 @@
+import copy
 import NetworkMdp
-import DynamicMethods
-import matplotlib.pyplot as plt
+import HopOracle
+import QueueingSimulator
+import TrafficMetrics
+import Checkpoint
 import random
 import numpy as np
 
@@ -9,71 +12,101 @@ class TrafficGenerator:
     def __init__(self, solver):
         self.solver = solver
 
-    def simulate(self, packet_count, method, disable_nodes=True, max_hops=100):
-        destination = (2, 3)
-        ratio = []
-        averages = []
-        average = 0
-        optimal_percent = []
-        optimal_count = 0
-
-        # Use value iteration to find the policy in order to find the optimal distance
-        dp = DynamicMethods.DynamicMethods(self.solver.network.mapfile, self.solver.network.topology)
-        dp.value_iteration(0.9, 0.001)
+    # Simulate queueing under load with the solver making the forwarding decisions, see QueueingSimulator.run
+    def simulate_load(self, duration, rate, trace=None, max_hops=100, service_time=1.0, link_delay=0.0, seed=None):
+        simulator = QueueingSimulator.QueueingSimulator(self.solver, service_time, link_delay, seed)
+        return simulator.run(duration, rate, trace, max_hops)
+
+    # Send packets from random origins and record how their hops compare to the optimal distance. Metrics are kept in
+    # bounded memory (see TrafficMetrics), max_points and flush_prefix are passed on to it. The metrics are plotted at
+    # the end if plot is set. With a checkpoint directory, the solver is saved every checkpoint_every packets and at the
+    # end, and a run with an existing checkpoint resumes from it. With a Profiler, the solver's phases are timed during
+    # the run, the profile is reported at the end and its per-sample series (see Profiler.series) is kept in the
+    # metrics' profile, and written to flush_prefix_profile.npz with a flush_prefix
+    def simulate(self, packet_count, method, disable_nodes=True, max_hops=100, max_points=10000, flush_prefix=None,
+                 plot=True, checkpoint=None, checkpoint_every=10000, profiler=None):
+        destination = tuple(np.argwhere(self.solver.network.nodes == NetworkMdp.DESTINATION)[0])
+        metrics = TrafficMetrics.TrafficMetrics(max_points, flush_prefix)
+
+        # Search the original network once to find the optimal distance from every origin
+        oracle = HopOracle.HopOracle(copy.deepcopy(self.solver.network))
 
         orig_network = np.copy(self.solver.network.nodes)
-        for packet in range(1, packet_count):
-            # Randomly choose origin node
-            origin = (random.randint(0, self.solver.network.nodes.shape[0] - 1), random.randint(0, self.solver.network.nodes.shape[1] - 1))
 
-            # Send the packet
-            hops = self.solver.send_packet(origin, max_hops)
+        first_packet = 1
+        if checkpoint is not None:
+            checkpoint = Checkpoint.Checkpoint(checkpoint)
+            if checkpoint.exists():
+                first_packet = checkpoint.load(self.solver) + 1
+
+        if profiler is not None:
+            profiler.attach(self.solver)
+
+        try:
+            for packet in range(first_packet, packet_count):
+                # Randomly choose origin node
+                origin = (random.randint(0, self.solver.network.nodes.shape[0] - 1), random.randint(0, self.solver.network.nodes.shape[1] - 1))
+
+                # Send the packet
+                hops = self.solver.send_packet(origin, max_hops)
+
+                # Compare to the optimal distance
+                metrics.record(hops, oracle.distance(origin))
+
+                if disable_nodes:
+                    # Every 2000 packets, disable 1-3 nodes
+                    if packet % 2000 == 0:
+                        previous_network = np.copy(self.solver.network.nodes)
+                        self.solver.network.set_nodes(orig_network)
+
+                        for i in range(0, random.randint(1, 3)):
+                            inactive_x = random.randint(0, self.solver.network.nodes.shape[0] - 1)
+                            inactive_y = random.randint(0, self.solver.network.nodes.shape[1] - 1)
+                            self.solver.network.set_node((inactive_x, inactive_y), NetworkMdp.INACTIVE)
 
-            # Calculate optimal distance
-            distance = dp.send_packet(origin)
+                        self.solver.network.set_node(destination, NetworkMdp.DESTINATION)
 
-            # Account for a node sending a packet to itself
-            if distance == 0:
-                ratio.append(1.0)
-                optimal_count = optimal_count + 1
+                        if hasattr(self.solver, "replan"):
+                            # Let the solver repair its policy around the nodes that failed or recovered
+                            self.solver.replan(np.argwhere(previous_network != self.solver.network.nodes))
 
-            # Account for timeouts
-            elif (distance > 0) and (hops == NetworkMdp.TIMEOUT):
-                ratio.append(100.0)
+                if checkpoint is not None and packet % checkpoint_every == 0:
+                    checkpoint.save(self.solver, packet)
+        finally:
+            if profiler is not None:
+                profiler.detach()
 
-            else:
-                ratio.append(hops / distance)
-                if hops == distance:
-                    optimal_count = optimal_count + 1
+        if profiler is not None:
+            profiler.report()
+            metrics.profile = profiler.series()
+            if flush_prefix is not None:
+                np.savez(f"{flush_prefix}_profile.npz", **metrics.profile)
 
-            optimal_percent.append(optimal_count / packet)
+        if checkpoint is not None:
+            checkpoint.save(self.solver, max(first_packet, packet_count) - 1)
 
-            # Update the running average
-            average = (average * (packet - 1) / packet) + (ratio[-1] / packet)
-            averages.append(average)
+        metrics.flush()
+        if plot:
+            self.plot(metrics, method)
 
-            if disable_nodes:
-                # Every 2000 packets, disable 1-3 nodes
-                if packet % 2000 == 0:
-                    self.solver.network.nodes = np.copy(orig_network)
+        return metrics
 
-                    for i in range(0, random.randint(1, 3)):
-                        inactive_x = random.randint(0, self.solver.network.nodes.shape[0] - 1)
-                        inactive_y = random.randint(0, self.solver.network.nodes.shape[1] - 1)
-                        self.solver.network.nodes[inactive_x][inactive_y] = NetworkMdp.INACTIVE
+    def plot(self, metrics, method):
+        # Only pay for importing matplotlib when something is plotted
+        import matplotlib.pyplot as plt
 
-                    self.solver.network.nodes[2][3] = NetworkMdp.DESTINATION
+        series = metrics.series()
 
         fig, axes = plt.subplots(3)
         fig.suptitle(method)
 
-        axes[0].plot(ratio)
+        axes[0].plot(series["packets"], series["ratios"])
         axes[0].set(ylabel="Relative Hops")
 
-        axes[1].plot(averages, 'tab:red')
+        axes[1].plot(series["packets"], series["averages"], 'tab:red')
         axes[1].set(ylabel="Relative Hops (Average)")
 
-        axes[2].plot(optimal_percent, 'tab:green')
+        axes[2].plot(series["packets"], series["optimal_percents"], 'tab:green')
         axes[2].set(ylabel="% Optimal")
 
         plt.show()
@@ -0,0 +1,166 @@
+import NetworkMdp
+import numpy as np
+
+# Relative hops recorded for a packet that timed out
+TIMEOUT_RATIO = 100.0
+
+
+# Whether a packet that took hops timed out. Solvers report a timeout as NetworkMdp.TIMEOUT
+def timed_out(hops):
+    return hops == NetworkMdp.TIMEOUT
+
+
+class TrafficMetrics:
+    def __init__(self, max_points=10000, flush_prefix=None, chunk_size=100000):
+        # Running aggregates over every packet
+        self.count = 0
+        self.optimal_count = 0
+        self.timeouts = 0
+        self.average = 0.0
+        self.max_ratio = 0.0
+
+        # Series of every stride-th packet. Once max_points are recorded every other point is dropped and the stride
+        # doubles, so the series always covers the whole run in bounded memory
+        self.max_points = max_points
+        self.stride = 1
+        self.size = 0
+        self.packets = np.zeros(max_points, np.int64)
+        self.ratios = np.zeros(max_points)
+        self.averages = np.zeros(max_points)
+        self.optimal_percents = np.zeros(max_points)
+
+        # Hops, optimal distance and relative hops of every packet are written to flush_prefix_<chunk>.npz files of
+        # chunk_size packets each (nothing is written by default)
+        self.flush_prefix = flush_prefix
+        self.chunk_size = chunk_size
+        self.chunks = 0
+        self.chunk_fill = 0
+        if flush_prefix is not None:
+            self.chunk_hops = np.zeros(chunk_size, np.int32)
+            self.chunk_distances = np.zeros(chunk_size, np.int32)
+            self.chunk_ratios = np.zeros(chunk_size)
+
+        # Profiler series of the run, when it was profiled (see TrafficGenerator.simulate)
+        self.profile = None
+
+    # Record a packet that took hops to travel an optimal distance, returns its relative hops
+    def record(self, hops, distance):
+        # Account for a node sending a packet to itself
+        if distance == 0:
+            ratio = 1.0
+            self.optimal_count = self.optimal_count + 1
+
+        # Account for timeouts
+        elif (distance > 0) and timed_out(hops):
+            ratio = TIMEOUT_RATIO
+            self.timeouts = self.timeouts + 1
+
+        else:
+            ratio = hops / distance
+            if hops == distance:
+                self.optimal_count = self.optimal_count + 1
+
+        self.count = self.count + 1
+
+        # Update the running average
+        self.average = (self.average * (self.count - 1) / self.count) + (ratio / self.count)
+        self.max_ratio = max(self.max_ratio, ratio)
+
+        if self.count % self.stride == 0:
+            if self.size == self.max_points:
+                self.decimate()
+            if self.count % self.stride == 0:
+                self.packets[self.size] = self.count
+                self.ratios[self.size] = ratio
+                self.averages[self.size] = self.average
+                self.optimal_percents[self.size] = self.optimal_count / self.count
+                self.size = self.size + 1
+
+        if self.flush_prefix is not None:
+            self.chunk_hops[self.chunk_fill] = hops
+            self.chunk_distances[self.chunk_fill] = distance
+            self.chunk_ratios[self.chunk_fill] = ratio
+            self.chunk_fill = self.chunk_fill + 1
+            if self.chunk_fill == self.chunk_size:
+                self.flush()
+
+        return ratio
+
+    # Keep every other point of the series, doubling the stride
+    def decimate(self):
+        self.stride = self.stride * 2
+        keep = np.flatnonzero(self.packets[:self.size] % self.stride == 0)
+        for series in (self.packets, self.ratios, self.averages, self.optimal_percents):
+            series[:keep.size] = series[keep]
+        self.size = keep.size
+
+    # Write the packets recorded since the last flush to the next chunk file
+    def flush(self):
+        if self.flush_prefix is None or self.chunk_fill == 0:
+            return
+
+        np.savez(f"{self.flush_prefix}_{self.chunks:06d}.npz", hops=self.chunk_hops[:self.chunk_fill],
+                 distances=self.chunk_distances[:self.chunk_fill], ratios=self.chunk_ratios[:self.chunk_fill])
+        self.chunks = self.chunks + 1
+        self.chunk_fill = 0
+
+    # Recorded series, indexed by packet number
+    def series(self):
+        return {
+            "packets": self.packets[:self.size],
+            "ratios": self.ratios[:self.size],
+            "averages": self.averages[:self.size],
+            "optimal_percents": self.optimal_percents[:self.size]
+        }
+
+    def summary(self):
+        return {
+            "packets": self.count,
+            "average_ratio": self.average,
+            "max_ratio": self.max_ratio,
+            "optimal_percent": self.optimal_count / self.count if self.count > 0 else 0.0,
+            "timeouts": self.timeouts
+        }
+
+
+class LatencyMetrics:
+    # Latencies of delivered packets in bounded memory: the count, mean and max are kept over every packet and the
+    # percentiles are taken over every stride-th latency, with the stride doubled whenever max_points are recorded like
+    # TrafficMetrics' series (so they're exact up to max_points packets)
+    def __init__(self, max_points=100000):
+        self.count = 0
+        self.mean = 0.0
+        self.max_latency = 0.0
+
+        self.max_points = max_points
+        self.stride = 1
+        self.size = 0
+        self.packets = np.zeros(max_points, np.int64)
+        self.latencies = np.zeros(max_points)
+
+    def record(self, latency):
+        self.count = self.count + 1
+        self.mean = self.mean + (latency - self.mean) / self.count
+        self.max_latency = max(self.max_latency, latency)
+
+        if self.count % self.stride == 0:
+            if self.size == self.max_points:
+                self.decimate()
+            if self.count % self.stride == 0:
+                self.packets[self.size] = self.count
+                self.latencies[self.size] = latency
+                self.size = self.size + 1
+
+    # Keep every other recorded latency, doubling the stride
+    def decimate(self):
+        self.stride = self.stride * 2
+        keep = np.flatnonzero(self.packets[:self.size] % self.stride == 0)
+        for series in (self.packets, self.latencies):
+            series[:keep.size] = series[keep]
+        self.size = keep.size
+
+    # Latency at each of the given percentiles (NaN if no packet was recorded)
+    def percentiles(self, percentiles):
+        if self.size == 0:
+            return [float("nan")] * len(percentiles)
+        return np.percentile(self.latencies[:self.size], percentiles).tolist()
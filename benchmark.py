@@ -0,0 +1,214 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+import NetworkMdp
+import DynamicMethods
+import QRouting
+import Sarsa
+import finitemdp
+
+SIZES = [4, 16, 64, 256, 1024]
+TOPOLOGIES = {"mesh": NetworkMdp.MESH, "torus": NetworkMdp.TORUS}
+SEED = 0
+
+# Fraction of nodes that are inactive in the generated maps
+FAILURE_DENSITY = 0.05
+
+
+# Seed both random number generators used by the solvers so every run sees the same maps and traffic
+def seed_all(seed=SEED):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def generate_map(size):
+    return NetworkMdp.generate_map(size, size, FAILURE_DENSITY, seed=SEED)
+
+
+def random_origins(network, count):
+    rng = np.random.default_rng(SEED)
+    return [tuple(origin) for origin in rng.integers(0, network.nodes.shape, (count, 2)).tolist()]
+
+
+# Each benchmark sets up what it needs for a network size and topology and returns a function to time, along with the
+# number of operations one call of that function does. Setup isn't timed
+
+def next_node(size, topology):
+    network = NetworkMdp.NetworkMdp(generate_map(size), topology)
+    origins = random_origins(network, 10000)
+    actions = [NetworkMdp.actions[action_id] for action_id in np.random.randint(0, 4, len(origins))]
+
+    def run():
+        for origin, action in zip(origins, actions):
+            network.next_node(origin, action)
+
+    return run, len(origins)
+
+
+def send_packet(size, topology):
+    dp = DynamicMethods.DynamicMethods(generate_map(size), topology, vectorized=True, seed=SEED)
+    dp.value_iteration(0.9, 0.001)
+    origins = random_origins(dp.network, 1000)
+
+    def run():
+        for origin in origins:
+            dp.network.send_packet(origin, 4 * size)
+
+    return run, len(origins)
+
+
+def value_iteration(size, topology, **kwargs):
+    dp = DynamicMethods.DynamicMethods(generate_map(size), topology, seed=SEED, **kwargs)
+
+    def run():
+        dp.network.values[...] = 0
+        dp.value_iteration(0.9, 0.001)
+
+    return run, 1
+
+
+def policy_iteration(size, topology, **kwargs):
+    dp = DynamicMethods.DynamicMethods(generate_map(size), topology, seed=SEED, **kwargs)
+    policies = np.copy(dp.network.policies)
+
+    def run():
+        dp.network.values[...] = 0
+        dp.network.policies[...] = policies
+        dp.policy_iteration(0.9, 0.001)
+
+    return run, 1
+
+
+def learner_send_packet(solver_class, size, topology, **kwargs):
+    solver = solver_class(generate_map(size), topology, seed=SEED, **kwargs)
+    origins = random_origins(solver.network, 1000)
+
+    def run():
+        for origin in origins:
+            solver.send_packet(origin, 100)
+
+    return run, len(origins)
+
+
+def finite_mdp_call(size, topology):
+    world = finitemdp.GridWorld(size, size)
+    actions = [world.actions[a] for a in np.random.randint(0, len(world.actions), 10000)]
+
+    def run():
+        for action in actions:
+            world(action)
+
+    return run, len(actions)
+
+
+# Benchmarks with the largest size they're run at, since the pure Python solvers take hours on the largest maps. The
+# learners keep learning between repeats, so their later repeats route with a better policy
+benchmarks = {
+    "NetworkMdp.next_node": (next_node, 1024),
+    "NetworkMdp.send_packet": (send_packet, 1024),
+    "DynamicMethods.value_iteration": (value_iteration, 64),
+    "DynamicMethods.value_iteration[vectorized]": (lambda size, topology: value_iteration(size, topology, vectorized=True), 1024),
+    "DynamicMethods.value_iteration[prioritized]": (lambda size, topology: value_iteration(size, topology, prioritized=True), 1024),
+    "DynamicMethods.value_iteration[parallel]": (lambda size, topology: value_iteration(size, topology, workers=os.cpu_count()), 1024),
+    "DynamicMethods.policy_iteration": (policy_iteration, 16),
+    "DynamicMethods.policy_iteration[vectorized]": (lambda size, topology: policy_iteration(size, topology, vectorized=True), 256),
+    "QRouting.send_packet": (lambda size, topology: learner_send_packet(QRouting.QRouting, size, topology), 1024),
+    "QRouting.send_packet[confidence_based]": (lambda size, topology: learner_send_packet(QRouting.QRouting, size, topology,
+                                                                                          confidence_based=True), 1024),
+    "Sarsa.send_packet": (lambda size, topology: learner_send_packet(Sarsa.Sarsa, size, topology), 1024),
+    "FiniteMDP.__call__": (finite_mdp_call, 256)
+}
+
+# Benchmarks that don't depend on the network topology, only run once per size
+topology_free = {"FiniteMDP.__call__"}
+
+
+# Time the function repeats times, returning the times of every repeat
+def time_repeats(function, repeats):
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names, sizes, topologies, repeats):
+    results = []
+    for name in names:
+        setup, max_size = benchmarks[name]
+        for topology in (topologies[:1] if name in topology_free else topologies):
+            for size in sizes:
+                if size > max_size:
+                    continue
+
+                # The solvers print their progress, keep it out of the results
+                seed_all()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    function, operations = setup(size, TOPOLOGIES[topology])
+                    times = time_repeats(function, repeats)
+
+                result = {
+                    "benchmark": name,
+                    "topology": None if name in topology_free else topology,
+                    "size": size,
+                    "operations": operations,
+                    "repeats": repeats,
+                    "min_seconds": min(times),
+                    "median_seconds": float(np.median(times)),
+                    "seconds_per_operation": min(times) / operations
+                }
+                results.append(result)
+                print(f"{name} {topology} {size}x{size}: {result['seconds_per_operation'] * 1e6:.2f} us/op "
+                      f"(min {result['min_seconds']:.4f} s of {repeats})", file=sys.stderr)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the routing hot paths on generated mesh and torus networks")
+    parser.add_argument("--benchmarks", nargs="+", choices=benchmarks.keys(), default=list(benchmarks.keys()))
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES, help="network sizes (size x size)")
+    parser.add_argument("--topologies", nargs="+", choices=TOPOLOGIES.keys(), default=list(TOPOLOGIES.keys()))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="JSON file the results are written to (stdout by default, with the progress "
+                                          "on stderr)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.benchmarks, args.sizes, args.topologies, args.repeats)
+
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "seed": SEED,
+        "results": results
+    }
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
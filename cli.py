@@ -0,0 +1,72 @@
+import argparse
+import NetworkMdp
+import numpy as np
+
+topologies = {
+    "mesh": NetworkMdp.MESH,
+    "torus": NetworkMdp.TORUS
+}
+
+
+def value_iteration(args):
+    import DynamicMethods
+    return DynamicMethods.main(args.map, topologies[args.topology], args.packets, args.plot)
+
+
+def q_routing(args):
+    import QRouting
+    return QRouting.main(args.map, topologies[args.topology], args.packets, args.plot, confidence_based=False)
+
+
+def confidence_q_routing(args):
+    import QRouting
+    return QRouting.main(args.map, topologies[args.topology], args.packets, args.plot, confidence_based=True)
+
+
+def distributed_q_routing(args):
+    import DistributedQRouting
+    return DistributedQRouting.main(args.map, topologies[args.topology], args.packets, args.plot)
+
+
+def sarsa(args):
+    import Sarsa
+    return Sarsa.main(args.map, topologies[args.topology], args.packets, args.plot)
+
+
+def episodic_sarsa(args):
+    import main
+    return main.main(args.map, topologies[args.topology], args.packets, args.plot)
+
+
+solvers = {
+    "value-iteration": value_iteration,
+    "q-routing": q_routing,
+    "confidence-q-routing": confidence_q_routing,
+    "distributed-q-routing": distributed_q_routing,
+    "sarsa": sarsa,
+    "episodic-sarsa": episodic_sarsa
+}
+
+
+# Run one of the solvers on random traffic without any plots, unless --plot is given
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Route random traffic through a network with one of the solvers")
+    parser.add_argument("solver", choices=solvers.keys())
+    parser.add_argument("--map", default="mesh4x4.txt", help="network map file")
+    parser.add_argument("--topology", choices=topologies.keys(), default="torus")
+    parser.add_argument("--packets", type=int, default=10000, help="number of packets to send")
+    parser.add_argument("--plot", action="store_true", help="plot the results at the end of the run")
+    args = parser.parse_args(argv)
+
+    result = solvers[args.solver](args)
+
+    if isinstance(result, list):
+        # The episodic SARSA only records relative hops
+        print(f"Average relative hops: {np.mean(result):.3f}")
+    else:
+        for name, value in result.summary().items():
+            print(f"{name}: {value}")
+
+
+if __name__ == '__main__':
+    main()
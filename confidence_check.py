@@ -0,0 +1,69 @@
+import NetworkMdp
+import QRouting
+import numpy as np
+
+
+# Tables of a solver after applying the visits with backward_loop (one visit at a time) and with backward_arrays
+def both_updates(solver, flat_nodes, actions, times):
+    results = []
+    for update in (solver.backward_loop, solver.backward_arrays):
+        q = np.copy(solver.q)
+        c = np.copy(solver.c)
+        if update == solver.backward_loop:
+            update(flat_nodes.tolist(), actions.tolist(), times.tolist(), q, c)
+        else:
+            update(flat_nodes, actions, times, q, c)
+        results.append((q, c))
+    return results
+
+
+# Check that the vectorized backward update leaves the same Q and confidence tables as updating one visit at a time
+def check_backward_update(solver, flat_nodes, actions, times):
+    (loop_q, loop_c), (arrays_q, arrays_c) = both_updates(solver, flat_nodes, actions, times)
+    return (np.array_equal(loop_q, arrays_q) and not np.any(np.isnan(arrays_c)) and
+            np.allclose(loop_c, arrays_c, rtol=1e-6, atol=1e-300))
+
+
+# Random walk of the given length through the network, as flat nodes and actions
+def random_path(solver, length, rng):
+    transitions = solver.network.transitions.reshape(-1)
+    nodes = np.zeros(length, np.int64)
+    actions = rng.integers(0, solver.network.action_count, length)
+    node = int(rng.integers(0, solver.network.nodes.size))
+    for hop in range(length):
+        nodes[hop] = node
+        node = transitions[solver.network.flat_links(node, actions[hop])]
+    return nodes, actions
+
+
+def main():
+    rng = np.random.default_rng(0)
+    solver = QRouting.QRouting("mesh4x4.txt", NetworkMdp.TORUS, confidence_based=True, seed=0)
+
+    # Learn for a while so the tables aren't uniform
+    for packet in range(2000):
+        solver.send_packet((int(rng.integers(0, 4)), int(rng.integers(0, 4))))
+
+    results = {}
+    for length in [1, 3, 10, 63, 64, 100, 1000]:
+        nodes, actions = random_path(solver, length, rng)
+        results[f"Path of {length} hops"] = check_backward_update(solver, nodes, actions, length - np.arange(length))
+
+    # Several packets' paths at once, as send_packets' backward pass applies them
+    nodes, actions = random_path(solver, 5000, rng)
+    results["Repeated paths"] = check_backward_update(solver, nodes, actions, rng.integers(1, 200, nodes.size))
+
+    # Thousands of visits to one entry, alternately raising and lowering its estimate
+    visits = 16000
+    nodes = np.zeros(visits, np.int64)
+    actions = np.zeros(visits, np.int64)
+    results["Alternating visits to one entry"] = check_backward_update(solver, nodes, actions,
+                                                                       np.where(np.arange(visits) % 2 == 0, 5, 1))
+    results["Repeated increases of one entry"] = check_backward_update(solver, nodes, actions, np.ones(visits, np.int64))
+
+    for name, match in results.items():
+        print(f"{name}: " + ("tables match" if match else "TABLES DIFFER"))
+
+
+if __name__ == '__main__':
+    main()
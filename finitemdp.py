@@ -8,7 +8,38 @@ Class for a finite Markov Descision Process
 """
 
 import numpy as np
-import copy
+import NetworkMdp
+
+# Index of the "goal" state shared by every goal cell in a GridWorld
+GOAL_INDEX = 0
+
+# (row, col) offset of each GridWorld action, in the same order as GridWorld.actions
+GRID_MOVES = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+
+# Build Vose alias tables for sampling from a discrete distribution in O(1): pick a column k uniformly, then keep k with
+# probability prob[k] or take alias[k] otherwise
+def alias_table(probs):
+    n = len(probs)
+    total = float(sum(probs))
+    scaled = [p * n / total for p in probs]
+    prob = [1.0] * n
+    alias = list(range(n))
+
+    small = [k for k, p in enumerate(scaled) if p < 1.0]
+    large = [k for k, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = scaled[l] + scaled[s] - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    return prob, alias
+
 
 class FiniteMDP(object):
     def __init__(self, states, actions, dynamics, reward, init_state=None):
@@ -16,39 +47,84 @@ class FiniteMDP(object):
         self.actions = actions
         self.dynamics_func = dynamics
         self.reward_func = reward
+
+        # Integer index of every state and action
+        self.state_index = {s: k for k, s in enumerate(self.states)}
+        self.action_index = {a: k for k, a in enumerate(self.actions)}
+
+        # Compiled transition model, filled in one (state, action) row at a time the first time it's needed
+        self._model = {}
         
         if init_state is None:
             self._state = np.random.choice(self.states)
         else:
             self._state = init_state
 
-        assert self._state in self.states
+        assert self._state in self.state_index
 
     def __call__(self, action):
-        assert action in self.actions
-        new_state = np.random.choice(self.states, p=[self.dynamics(self._state, self.states[k], action) for k in self.states])
-        reward = self.reward(self._state, new_state, action)
+        assert action in self.action_index
+        next_states, rewards, prob, alias = self.model(self.state_index[self._state], self.action_index[action])
+
+        # Sample the next state from the alias tables with a single random number
+        u = np.random.random() * len(next_states)
+        k = int(u)
+        if u - k >= prob[k]:
+            k = alias[k]
+
+        new_state = self.states[next_states[k]]
+        reward = rewards[k]
         self._state = new_state
         return new_state, reward
 
     def dynamics(self, state, state_prime, action):
-        assert state in self.states
-        assert state_prime in self.states
-        assert action in self.actions
+        assert state in self.state_index
+        assert state_prime in self.state_index
+        assert action in self.action_index
         return self.dynamics_func(state, state_prime, action)
 
     def reward(self, state, state_prime, action):
-        assert state in self.states
-        assert state_prime in self.states
-        assert action in self.actions
+        assert state in self.state_index
+        assert state_prime in self.state_index
+        assert action in self.action_index
         return self.reward_func(state, state_prime, action)
 
+    # Indices of the states reachable from state index s by taking action index a, and the probability of each. Asks
+    # the dynamics about every state, subclasses that know their successors can override this
+    def transition_row(self, s, a):
+        state = self.states[s]
+        action = self.actions[a]
+        probs = [self.dynamics_func(state, state_prime, action) for state_prime in self.states]
+        next_states = [k for k, p in enumerate(probs) if p > 0.0]
+        return next_states, [probs[k] for k in next_states]
+
+    # Compiled (next state indices, rewards, alias probabilities, aliases) for state index s and action index a
+    def model(self, s, a):
+        row = self._model.get((s, a))
+        if row is None:
+            next_states, probs = self.transition_row(s, a)
+            rewards = [self.reward_func(self.states[s], self.states[k], self.actions[a]) for k in next_states]
+            prob, alias = alias_table(probs)
+            row = (next_states, rewards, prob, alias)
+            self._model[(s, a)] = row
+        return row
+
+    # Compile the transition model for every state and action up front
+    def compile(self):
+        for s in range(len(self.states)):
+            for a in range(len(self.actions)):
+                self.model(s, a)
+
+    # Throw away the compiled transition model, e.g. after the dynamics have changed
+    def invalidate(self):
+        self._model = {}
+
 
 class DiceGame(FiniteMDP):
     def __init__(self):
         states = ["playing", "end"]
         actions = ["continue", "quit"]
-        super().__init__(states, actions, self.dice_dynamics, self.reward, "playing")
+        super().__init__(states, actions, self.dice_dynamics, self.dice_reward, "playing")
     
     def dice_dynamics(self, state, state_prime, action):
         # return probability that taking an action from state will result in state_prime
@@ -67,6 +143,15 @@ class DiceGame(FiniteMDP):
                 return 1.0
             else:
                 return 0.0
+
+
+    def dice_reward(self, state, state_prime, action):
+        # same rewards as sar_dynamics
+        if state == "playing" and action == "quit":
+            return 5.0
+        elif state == "playing" and action == "continue":
+            return 3.0
+        return 0.0
             
     def roll_dice(self):
         sides = [1, 2, 3, 4, 5, 6]
@@ -108,71 +193,82 @@ class GridWorld(FiniteMDP):
             init_pos = f"{init_pos[0]},{init_pos[1]}"
         
         self.map = map
-        
-        states = ["goal"]
-        for i in range(self.map.shape[0]):
-            for j in range(self.map.shape[1]):
-                name = f"{i},{j}"
-                if self.map[i, j] == 0:
-                    states.append(name)
+
+        # Integer state encoding: state k > 0 is the free cell cells[k], index maps every cell back to its state
+        # (GOAL_INDEX for goals, -1 for obstacles). The string names in states are only kept for compatibility
+        self.cells = np.concatenate([[[-1, -1]], np.argwhere(self.map == 0)])
+        self.index = np.full(self.map.shape, -1)
+        self.index[self.cells[1:, 0], self.cells[1:, 1]] = np.arange(1, len(self.cells))
+        self.index[self.map == -1] = GOAL_INDEX
+
+        states = ["goal"] + [f"{i},{j}" for i, j in self.cells[1:]]
         actions = ["up", "down", "left", "right"]
         super().__init__(states, actions, self.gw_dynamics, self.gw_reward, init_pos)
-    
+
+    # The map is read-only so cached transitions can't go stale: change cells with set_cell or assign a whole new map.
+    # The set of states is fixed when the world is made
+    @property
+    def map(self):
+        return self._map
+
+    @map.setter
+    def map(self, map):
+        self._map = np.array(map)
+        self._map.setflags(write=False)
+        self.invalidate()
+
+    # Set a cell of the map (0 free, 1 obstacle, -1 goal). Negative indices would silently wrap around to the other side
+    # of the map (e.g. the (-1, -1) cell of the goal state), so they're rejected
+    def set_cell(self, i, j, value):
+        if i < 0 or j < 0:
+            raise IndexError(f"Cell ({i}, {j}) is off the map")
+        if self._map[i, j] != value:
+            self._map.setflags(write=True)
+            self._map[i, j] = value
+            self._map.setflags(write=False)
+            self.invalidate()
+
+    # State indices of the cells at the given rows and cols, according to the current map (GOAL_INDEX for goals, -1
+    # for obstacles)
+    def to_index(self, rows, cols):
+        cell = self.map[rows, cols]
+        return np.where(cell == -1, GOAL_INDEX, np.where(cell == 1, -1, self.index[rows, cols]))
+
+    # (row, col) of the cells of the given state indices, (-1, -1) for the goal
+    def to_cell(self, s):
+        return self.cells[s]
+
+    # Next state index and reward for taking action index a from state index s
+    def step(self, s, a):
+        if s == GOAL_INDEX:
+            return GOAL_INDEX, 0.0
+
+        # Moves off of the map leave the position unchanged
+        row = min(max(self.cells[s, 0] + GRID_MOVES[a, 0], 0), self.map.shape[0] - 1)
+        col = min(max(self.cells[s, 1] + GRID_MOVES[a, 1], 0), self.map.shape[1] - 1)
+
+        if self.map[row, col] == -1:
+            return GOAL_INDEX, 0.0
+        if self.map[row, col] == 1 or self.index[row, col] < 0:
+            # Blocked by an obstacle (or a cell that wasn't free when the world was made), stay put
+            return s, -1.0
+        return int(self.index[row, col]), -1.0
+
     def gw_dynamics(self, state, new_state, action):
-        if state == "goal":
-            if new_state == "goal":
-                return 1.0
-            else:
-                return 0.0
+        s, reward = self.step(self.state_index[state], self.action_index[action])
+        if s == self.state_index[new_state]:
+            return 1.0
         else:
-            print(state, type(state))
-            pos = [int(k) for k in state.split(",")]
-            if action == "up" and pos[0] != 0:
-                pos[0] -= 1
-            elif action == "down" and pos[0] != self.map.shape[0]-1:
-                pos[0] += 1
-            elif action == "right" and pos[1] != self.map.shape[1]-1:
-                pos[1] += 1
-            elif action == "left" and pos[1] != 0:
-                pos[1] -= 1
-            
-            new_name = f"{pos[0]},{pos[1]}"
-            if  self.map[pos[0], pos[1]] == -1:
-                new_name = "goal"
-            if self.map[pos[0], pos[1]] == 1:
-                new_name = state
-
-            if new_name == new_state:
-                return 1.0
-            else:
-                return 0.0
+            return 0.0
             
     def sar_dynamics(self, state, action):
-        reward = -1.0
-        if state == "goal":
-            reward = 0.0
-            new_name = "goal"
+        s, reward = self.step(self.state_index[state], self.action_index[action])
+        return self.states[s], reward
 
-        else:
-            pos = [int(k) for k in state.split(",")]
-            if action == "up" and pos[0] != 0:
-                pos[0] -= 1
-            elif action == "down" and pos[0] != self.map.shape[0]-1:
-                pos[0] += 1
-            elif action == "right" and pos[1] != self.map.shape[1]-1:
-                pos[1] += 1
-            elif action == "left" and pos[1] != 0:
-                pos[1] -= 1
-            
-            new_name = f"{pos[0]},{pos[1]}"
-            if  self.map[pos[0], pos[1]] == -1:
-                new_name = "goal"
-                reward = 0.0
-            if self.map[pos[0], pos[1]] == 1:
-                new_name = state
-                reward = -1.0
-            
-        return new_name, reward
+    # Moves in a GridWorld are deterministic, so the successor comes straight from step
+    def transition_row(self, s, a):
+        new_s, reward = self.step(s, a)
+        return [new_s], [1.0]
 
     def gw_reward(self, state, new_state, action):
         if new_state == "goal":
@@ -180,72 +276,79 @@ class GridWorld(FiniteMDP):
         else:
             return -1.0
     
+    # Maps are saved as space separated text, or binary (int8) if the file name ends in .npy
     def save_map(self, filename):
-        with open(filename, "w") as f:
-            for i in range(self.map.shape[0]):
-                for j in range(self.map.shape[1]):
-                    f.write(f"{int(self.map[i, j])}")
-                    if j != self.map.shape[1]-1:
-                        f.write(" ")
-                f.write("\n")
+        NetworkMdp.save_map(self.map, filename)
     
     @staticmethod
     def from_file(filename):
-        map = []
-        with open(filename, "r") as f:
-            for line in f.readlines():
-                map.append([int(s) for s in line.split(" ")])
-                print(map)
-        print(np.array(map))
-        return GridWorld(map=np.array(map))
+        return GridWorld(map=NetworkMdp.load_map(filename).astype(int))
 
 class SlipperyGridWorld(GridWorld):
     def __init__(self, rows=None, cols=None, goals=None, obs=None, goal_percent=0.01, obs_percent=0.25, map=None, init_pos=None, p=0.1):
+        # Where a slide from each (state index, action index) can end up, computed the first time it's needed and
+        # thrown away whenever the map or p changes
+        self._slides = {}
+        self._p = p
         super().__init__(rows=rows, cols=cols, goals=goals, obs=obs, goal_percent=goal_percent, obs_percent=obs_percent, map=map, init_pos=init_pos)
-        self.p = p
 
-    def gw_dynamics(self, state, new_state, action):
-        if state == "goal":
-            if new_state == "goal":
-                return 1.0
-            else:
-                return 0.0
-        pos = np.array([int(k) for k in state.split(",")])
-        
-        delta = np.zeros(2, "int")
-        if action == "up":
-            delta[0] = -1
-        elif action == "down":
-            delta[0] = 1
-        elif action == "left":
-            delta[1] = -1
-        elif action == "right":
-            delta[1] = 1
-
-        ps = [0.0]
-        p_goal = 0.0
-        new_pos = copy.copy(pos)
+    # Probability of sliding on to the next cell
+    @property
+    def p(self):
+        return self._p
+
+    @p.setter
+    def p(self, p):
+        self._p = p
+        self.invalidate()
+
+    def invalidate(self):
+        super().invalidate()
+        self._slides = {}
+
+    # Distribution of where a slide from state index s in the direction of action index a ends up, as (next state
+    # indices, probabilities)
+    def slide(self, s, a):
+        row = self._slides.get((s, a))
+        if row is None:
+            row = self.compute_slide(s, a)
+            self._slides[(s, a)] = row
+        return row
+
+    def compute_slide(self, s, a):
+        if s == GOAL_INDEX:
+            return [GOAL_INDEX], [1.0]
+
+        # Each cell moved through stops the slide with probability 1 - p, until an obstacle or the edge of the map
+        # stops it for sure. Slides carry on through goal cells
+        probs = {}
+        row, col = self.cells[s]
+        current = s
         p = 1.0
         while 1:
-            new_pos += delta
-            if new_pos[0] >= self.map.shape[0] or new_pos[0] < 0 or new_pos[1] >= self.map.shape[1] or new_pos[1] < 0 or self.map[new_pos[0], new_pos[1]] == 1:
-                ps[-1] += p
+            row += GRID_MOVES[a, 0]
+            col += GRID_MOVES[a, 1]
+            if row < 0 or row >= self.map.shape[0] or col < 0 or col >= self.map.shape[1] or self.map[row, col] == 1 or \
+                    (self.map[row, col] != -1 and self.index[row, col] < 0):
+                probs[current] = probs.get(current, 0.0) + p
                 break
-            ps.append(p*(1 - self.p))
+
+            current = GOAL_INDEX if self.map[row, col] == -1 else int(self.index[row, col])
+            probs[current] = probs.get(current, 0.0) + p * (1 - self.p)
             p *= self.p
-            if self.map[new_pos[0], new_pos[1]] == -1:
-                p_goal += ps[-1]
-        
-        if new_state == "goal":
-            return p_goal
-        
-        rel_pos = np.array([int(k) for k in new_state.split(",")]) - pos
-        if np.linalg.norm(rel_pos) !=0 and np.any(rel_pos/np.linalg.norm(rel_pos) != delta):
-            return 0.0
-        rel_pos = np.abs(np.sum(rel_pos))
-        if rel_pos >= len(ps):
-            return 0.0
-        return ps[rel_pos]
+
+        return list(probs.keys()), list(probs.values())
+
+    def transition_row(self, s, a):
+        return self.slide(s, a)
+
+    def gw_dynamics(self, state, new_state, action):
+        next_states, probs = self.slide(self.state_index[state], self.action_index[action])
+        new_s = self.state_index[new_state]
+        for next_s, p in zip(next_states, probs):
+            if next_s == new_s:
+                return p
+        return 0.0
     
     @staticmethod
     def from_file(filename, p=0.1):
@@ -1,14 +1,15 @@
 import NetworkMdp
 import DynamicMethods
+import ActionSelector
 import numpy as np
 import random
-import matplotlib.pyplot as plt
 
 
 class Sarsa:
-    def __init__(self, network):
+    def __init__(self, network, seed=None):
         self.q = np.zeros((network.nodes.shape[0], network.nodes.shape[1], len(NetworkMdp.actions)))
         self.network = network
+        self.selector = ActionSelector.ActionSelector(seed)
 
     def send_packet(self, origin, epsilon, alpha, gamma):
         current_node = origin
@@ -16,7 +17,7 @@ class Sarsa:
 
         hops = 0
         while self.network.node(current_node) != NetworkMdp.DESTINATION:
-            next_node, reward = self.network.next_node(current_node, NetworkMdp.actions[action])
+            next_node, reward = self.network.transition(current_node, action)
             next_action = self.get_action(next_node, epsilon)
 
             q_current = self.q[current_node[0]][current_node[1]][action]
@@ -37,37 +38,16 @@ class Sarsa:
         return hops
 
     def get_action(self, node, epsilon):
-        if random.uniform(0, 1) <= epsilon:
-            # Randomly return an action
-            return random.randint(0, len(NetworkMdp.actions) - 1)
-
-        best_q = float('-inf')
-        best_actions = []
-        for action in NetworkMdp.actions.keys():
-            q = self.q[node[0]][node[1]][action]
-
-            if q > best_q:
-                best_q = q
-                best_actions.clear()
-                best_actions.append(action)
-            elif q == best_q:
-                best_actions.append(action)
-
-        if len(best_actions) == 0:
-            # No actions found that maximize the Q function, randomly pick one
-            return np.random.randint(0, len(NetworkMdp.actions) - 1)
-        else:
-            # Randomly pick an action from the best actions that maximized the Q function
-            return best_actions[np.random.randint(0, len(best_actions))]
-
-
-def main():
-    network = NetworkMdp.NetworkMdp("mesh4x4.txt")
+        return self.selector.select(self.q[node[0], node[1]], epsilon)
+
+
+def main(mapfile="mesh4x4.txt", topology=NetworkMdp.MESH, packet_count=10000, plot=True):
+    network = NetworkMdp.NetworkMdp(mapfile, topology)
     sarsa = Sarsa(network)
 
     orig_map = np.copy(network.nodes)
     ratio = []
-    for ep in range(0, 10000):
+    for ep in range(0, packet_count):
         if ep % 100 == 0:
             print("Episode " + str(ep))
 
@@ -79,13 +59,18 @@ def main():
             ratio.append(hops / distance)
 
         if ep % 500 == 0:
-            network.nodes = np.copy(orig_map)
-            network.nodes[random.randint(0, 3)][random.randint(0, 3)] = NetworkMdp.INACTIVE
-            network.nodes[2][3] = NetworkMdp.DESTINATION
+            network.set_nodes(orig_map)
+            network.set_node((random.randint(0, 3), random.randint(0, 3)), NetworkMdp.INACTIVE)
+            network.set_node((2, 3), NetworkMdp.DESTINATION)
 
     #network.render("SARSA", "sarsa.html")
-    plt.plot(ratio)
-    plt.show()
+    if plot:
+        import matplotlib.pyplot as plt
+
+        plt.plot(ratio)
+        plt.show()
+
+    return ratio
 
 
 if __name__ == '__main__':
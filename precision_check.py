@@ -0,0 +1,72 @@
+import NetworkMdp
+import DynamicMethods
+import QRouting
+import Sarsa
+import random
+import numpy as np
+
+
+# Seed the module level random number generators, which pick the packets' origins. The solvers' own ActionSelector is
+# seeded through their seed argument, so the FULL and COMPACT runs see the same traffic and make the same choices
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+# Number of hops from every origin to the destination when following the network's policy
+def policy_hops(network, max_hops=100):
+    hops = np.zeros(network.nodes.shape, int)
+    for x in range(0, network.nodes.shape[0]):
+        for y in range(0, network.nodes.shape[1]):
+            hops[x, y] = network.send_packet((x, y), max_hops)
+    return hops
+
+
+# Check that the DP policy found with COMPACT storage routes every packet as well as the FULL (float64) policy
+def check_dynamic_methods(mapfile, topology, vectorized=True, discount=0.9, theta=0.001):
+    hops = []
+    for precision in (NetworkMdp.FULL, NetworkMdp.COMPACT):
+        seed_all(0)
+        dp = DynamicMethods.DynamicMethods(mapfile, topology, vectorized, seed=0, precision=precision)
+        dp.value_iteration(discount, theta)
+        hops.append(policy_hops(dp.network))
+
+    return (hops[0] == hops[1]).all()
+
+
+# Check that the greedy policy learned with FULL (float64) storage routes every packet the same way once its tables are
+# stored with COMPACT precision. Learning itself is chaotic (any rounding difference changes later exploration), so the
+# learned tables are compared rather than two independent training runs
+def check_learner(solver_class, mapfile, topology, packet_count=10000, **kwargs):
+    seed_all(0)
+    full = solver_class(mapfile, topology, precision=NetworkMdp.FULL, seed=0, **kwargs)
+    for packet in range(packet_count):
+        origin = (random.randint(0, full.network.nodes.shape[0] - 1), random.randint(0, full.network.nodes.shape[1] - 1))
+        full.send_packet(origin)
+
+    compact = solver_class(mapfile, topology, precision=NetworkMdp.COMPACT, seed=0, **kwargs)
+    compact.q[...] = full.q
+    if getattr(full, "confidence_based", False):
+        compact.c[...] = full.c
+
+    full.greedy_policy()
+    compact.greedy_policy()
+    return (policy_hops(full.network) == policy_hops(compact.network)).all()
+
+
+def main():
+    for topology, name in [(NetworkMdp.MESH, "Mesh"), (NetworkMdp.TORUS, "Torus")]:
+        results = {
+            "Value Iteration": check_dynamic_methods("mesh4x4.txt", topology, vectorized=False),
+            "Vectorized Value Iteration": check_dynamic_methods("mesh4x4.txt", topology, vectorized=True),
+            "Q-Routing": check_learner(QRouting.QRouting, "mesh4x4.txt", topology),
+            "Confidence Q-Routing": check_learner(QRouting.QRouting, "mesh4x4.txt", topology, confidence_based=True),
+            "SARSA": check_learner(Sarsa.Sarsa, "mesh4x4.txt", topology)
+        }
+
+        for method, match in results.items():
+            print(f"{name} {method}: " + ("policies match" if match else "POLICIES DIFFER"))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,10 @@ Created on Sun Mar 27 16:43:54 2022
 @author: Juliana Curry
 """
 import numpy as np
+import ActionSelector
+import QHistory
 from bokeh.plotting import figure, save, show
-import copy
-from finitemdp import GridWorld
+from finitemdp import GridWorld, GOAL_INDEX
 
 N_EPISODES = 1000
 MAX_LOOPS = 100
@@ -15,74 +16,61 @@ GAMMA = 0.9
 EPSILON = 0.01
 
 class SARSA(object):
-    def __init__(self, world, alpha, source, dest):
+    def __init__(self, world, alpha, source, dest, seed=None, history=QHistory.RING, history_every=1, history_size=1000):
         self.world = world
         dest = dest.split(",")
-        self.world.map[int(dest[0]), int(dest[1])] = -1
+        self.world.set_cell(int(dest[0]), int(dest[1]), -1)
         print(self.world.map)
-        self.source = source
+        self.source = self.world.state_index[source]
         self.alpha = alpha
+        self.selector = ActionSelector.ActionSelector(seed)
         
-        self.q_func = {s: {"up": len(world.nodes) / 400,
-                      "down": len(world.nodes) / 400,
-                      "left": len(world.nodes) / 400,
-                      "right": len(world.nodes) / 400} for s in world.nodes}
-        self.policy = {s: np.random.choice(world.actions) for s in world.nodes}
-        self.values = {s: 0.0 for s in world.nodes}
-        self.q_func["goal"] = {"up": 0, "down": 0, "left": 0, "right": 0}
+        # Q function, policy and values are indexed by the world's integer state and action indices
+        n_states = len(world.states)
+        n_actions = len(world.actions)
+        self.q_func = np.full((n_states, n_actions), n_states / 400)
+        self.policy = np.random.randint(0, n_actions, n_states)
+        self.values = np.zeros(n_states)
+        self.q_func[GOAL_INDEX] = 0
         
-        self.hist = []
-        self.rewards = []
-        self.actions = []
-        self.states = []
+        # Changes to the Q function with the states, actions and rewards that made them, see QHistory for the modes
+        self.history = QHistory.QHistory(self.q_func, history, history_every, history_size)
     
     def __call__(self):
         s = self.source
         
         # generate episode using policy
-        if np.random.random() <= EPSILON: # e-greedy SARSA
-            # explore
-            a = np.random.choice(self.world.actions)
-        else:
-            # use optimal action from policy
-            a = self.policy.get(s)
-        self.states.append(s)
-        self.actions.append(a)
-        s_new, r = self.world.sar_dynamics(s, a)
-        self.rewards.append(r)
+        # e-greedy SARSA: explore, or use optimal action from policy
+        a = self.selector.epsilon_action(self.policy[s], EPSILON, len(self.world.actions))
+        s_new, r = self.world.step(s, a)
         
-        if np.random.random() <= EPSILON: # e-greedy SARSA
-            # explore
-            a_new = np.random.choice(self.world.actions)
-        else:
-            a_new = self.policy.get(s)
+        a_new = self.selector.epsilon_action(self.policy[s], EPSILON, len(self.world.actions))
                 
         #print(s, s_new, a, a_new)
         # now in s_new, it is an obstacle in other worlds now so remove it.
         # s is available again so add it back to the other worlds.
 
-        self.q_func[s][a] = self.q_func[s][a] + self.alpha*(r + GAMMA*self.q_func[s_new][a_new] - self.q_func[s][a])
-        q_list = [self.q_func[s]["up"], self.q_func[s]["down"], self.q_func[s]["left"], self.q_func[s]["right"]]
-        optimal_action = np.argmax(q_list)
-        self.policy[s] = {0:"up", 1:"down", 2:"left", 3:"right"}.get(optimal_action)
-        self.values[s] = q_list[optimal_action]
+        self.q_func[s, a] = self.q_func[s, a] + self.alpha*(r + GAMMA*self.q_func[s_new, a_new] - self.q_func[s, a])
+        self.history.record(s, a, r, self.q_func[s, a])
+        optimal_action = np.argmax(self.q_func[s])
+        self.policy[s] = optimal_action
+        self.values[s] = self.q_func[s, optimal_action]
         #print(self.policy[s])
-        s_prev = s.split(",")
-        s_current = s_new.split(",")
+        s_prev = self.world.to_cell(s)
+        s_current = self.world.to_cell(s_new)
         s = s_new
         a = a_new
-        self.hist.append(copy.copy(self.q_func))
 
         return s, [int(x) for x in s_current], [int(y) for y in s_prev]
 
 
 def plot_policy(world, pol, values, filename, method_title="Dynamic Programming"):
-    max_val = np.max([v for v in values.values()])
-    min_val = np.min([v for v in values.values()])
+    max_val = np.max(values)
+    min_val = np.min(values)
     if min_val == max_val:
-        values_norm = {k: 0.0 for k in values.keys()}
+        values_norm = np.zeros(len(values))
     else:
-        values_norm = {k: (v - min_val)/(max_val - min_val) for k, v in values.items()}
+        values_norm = (values - min_val)/(max_val - min_val)
 
     x_pos = []
     y_pos = []
@@ -105,14 +93,14 @@ def plot_policy(world, pol, values, filename, method_title="Dynamic Programming"
                 color.append("#00FF00")
                 n_feat += 1
 
-    for s in world.nodes:
-        if s == "goal":
+    for s in range(len(world.states)):
+        if s == GOAL_INDEX:
             continue
-        i, j = [int(v) for v in s.split(",")]
+        i, j = world.to_cell(s)
         x_pos.append(f"{j}")
         y_pos.append(f"{i}")
         color.append(f"#0000FF{format(int(255*values_norm[s]), '02X')}")
-        arrow.append(dir[pol[s]])
+        arrow.append(dir[world.actions[pol[s]]])
 
     fig = figure(
         title=f"{method_title}: GridWorld Policy and Values",
@@ -127,12 +115,12 @@ def plot_policy(world, pol, values, filename, method_title="Dynamic Programming"
 
 
 def plot_values(world, values, filename):
-    max_val = np.max([v for v in values.values()])
-    min_val = np.min([v for v in values.values()])
+    max_val = np.max(values)
+    min_val = np.min(values)
     if min_val == max_val:
-        values_norm = {k: 0.0 for k in values.keys()}
+        values_norm = np.zeros(len(values))
     else:
-        values_norm = {k: (v - min_val)/(max_val - min_val) for k, v in values.items()}
+        values_norm = (values - min_val)/(max_val - min_val)
 
     x_pos = []
     y_pos = []
@@ -152,10 +140,10 @@ def plot_values(world, values, filename):
                 color.append("#00FF00")
                 n_feat += 1 
 
-    for s in world.nodes:
-        if s == "goal":
+    for s in range(len(world.states)):
+        if s == GOAL_INDEX:
             continue
-        i, j = [int(v) for v in s.split(",")]
+        i, j = world.to_cell(s)
         x_pos.append(f"{j}")
         y_pos.append(f"{i}")
         color.append(f"#0000FF{format(int(255*values_norm[s]), '02X')}")
@@ -182,15 +170,23 @@ def main():
     s = None
     cnt = 0
     for _ in range(N_EPISODES):
-        while s != "goal" and cnt < 16:
+        while s != GOAL_INDEX and cnt < 16:
             s, p1_state, prev_p1s = p1_solver()
             print(p1_state, type(p1_state))
-            p2_solver.world.map[p1_state[0], p1_state[1]] = 1 # p1 state is an obstacle for p2
-            p2_solver.world.map[prev_p1s[0], p1_state[1]] = 0 # clear the old state
+            if s == GOAL_INDEX:
+                break
+            p2_solver.world.set_cell(p1_state[0], p1_state[1], 1) # p1 state is an obstacle for p2
+            p2_solver.world.set_cell(prev_p1s[0], p1_state[1], 0) # clear the old state
             s, p2_state, prev_p2s = p2_solver()
-            p1_solver.world.map[p2_state[0], p2_state[1]] = 1
-            p1_solver.world.map[prev_p2s[0], p2_state[1]] = 0
+            if s == GOAL_INDEX:
+                break
+            p1_solver.world.set_cell(p2_state[0], p2_state[1], 1)
+            p1_solver.world.set_cell(prev_p2s[0], p2_state[1], 0)
             cnt += 1
+
+        # Keep the changes of the episode's last steps when sampling the history
+        p1_solver.history.flush()
+        p2_solver.history.flush()
             
     plot_policy(p1_solver.world, p1_solver.policy, p1_solver.values, "p1sarsa_final.html", "SARSA")
     plot_policy(p2_solver.world, p2_solver.policy, p2_solver.values, "p2sarsa_final.html", "SARSA")